@@ -1,53 +1,374 @@
 ﻿import os
 import discord
 import asyncio
-from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,QPushButton, QListWidget, QFileDialog, QListWidgetItem, QMessageBox,QSlider, QLabel
-from PyQt6.QtCore import QThread, pyqtSignal, Qt, pyqtSlot
-from PyQt6.QtGui import QColor
+from discord import app_commands
 from discord.ext import commands
-from queue import Queue
 import time
 import shutil
 import logging
-import psutil
-from yt_dlp import YoutubeDL
-from collections import OrderedDict
+import json
+import re
+import threading
+import unicodedata
+import itertools
+import random
+import subprocess
+import sys
+import audioop
+import contextlib
+import importlib
+import argparse
+import signal
+import multiprocessing
+import hashlib
+import bisect
+import heapq
+import difflib
+import secrets
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from urllib.parse import urlparse, parse_qs, unquote
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Lazy imports
+class LazyModule:
+    # Initializes a stand-in for a module that is only imported on first use.
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    # Imports the module on first attribute access and forwards to it.
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+# Both take a while to load and a headless start may not need them straight away
+yt_dlp = LazyModule("yt_dlp")
+psutil = LazyModule("psutil")
+audio_worker = LazyModule("audio_worker")
+mutagen = LazyModule("mutagen")  # Optional, for song tags in the music library
+
 # Bot setup
 TOKEN = "YOUR_BOT_TOKEN_HERE"
-intents = discord.Intents.default()
-intents.message_content = True
-intents.guilds = True
-intents.voice_states = True
-intents.members = True
-intents.presences = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+GATEWAY_PROFILE = "full"  # "minimal" only receives guild and voice events; the commands are then slash commands only
+
+# Creates the bot for a gateway profile. "full" reads every message for the ! commands and receives
+# member and presence updates; "minimal" asks Discord for guild and voice state events only, caches
+# just the members in voice channels and keeps no message cache.
+def create_bot(profile):
+    if profile == "minimal":
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.voice_states = True
+        return commands.Bot(
+            command_prefix=commands.when_mentioned,
+            intents=intents,
+            member_cache_flags=discord.MemberCacheFlags.from_intents(intents),
+            max_messages=None,
+            chunk_guilds_at_startup=False,
+        )
+    intents = discord.Intents.default()
+    intents.message_content = True
+    intents.voice_states = True
+    intents.members = True
+    intents.presences = True
+    return commands.Bot(command_prefix="!", intents=intents)
+
+bot = create_bot(GATEWAY_PROFILE)
 
 # Constants
 QUICK_PLAY_FILE = "quick_play_files.txt"
 TEMP_DIR = os.path.join(os.path.dirname(__file__), "temp")
-MAX_CACHE_SIZE = 5
+CACHE_DIR = os.path.join(os.path.dirname(__file__), "cache")
+CACHE_INDEX_NAME = "index.json"
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_EVICTION_POLICY = "lru"
+CACHE_INDEX_SAVE_DELAY = 30.0  # Cache hits reach the index file within this many seconds; other changes are written at once
+CACHE_AUDIO_EXTENSIONS = (".mp3", ".webm", ".opus", ".m4a")
+RESOLUTION_CACHE_TTL = 6 * 60 * 60
+RESOLUTION_CACHE_MAX_ENTRIES = 1000
+RESOLUTION_CACHE_FILE = os.path.join(CACHE_DIR, "resolutions.json")
+RESOLUTION_NOISE_WORDS = frozenset({"official", "video", "audio", "lyrics", "lyric", "hd", "hq", "mv", "visualizer"})
+RESOLUTION_MIN_KEY_WORDS = 3  # Noise words are never stripped from a query with this many words or fewer
+STREAM_URL_EXPIRY_MARGIN = 10 * 60
+VOICE_CHANNEL_NAME = "tutturu~"
+MAX_QUEUE_SIZE = 50  # Default playlist capacity per guild
+MAX_PLAYLIST_SIZE = 500  # Most songs taken from one YouTube playlist; those that do not fit join the queue as it plays
+DEFAULT_PLAY_MODE = "stream"
+PREFETCH_DEPTH = 2
+DOWNLOAD_WORKERS = 2
+PRIORITY_NOW = 0
+PRIORITY_NEXT = 1
+PRIORITY_PREFETCH = 2
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+BYTES_PER_SECOND = discord.opus.Encoder.SAMPLING_RATE * discord.opus.Encoder.CHANNELS * 2
+SOUNDBOARD_MAX_BYTES = 64 * 1024 ** 2
+SOUNDBOARD_CHECK_INTERVAL = 2.0
+PLAY_MODE_FLAGS = {"--stream": "stream", "--download": "download"}
+CACHE_STREAMED_SONGS = True
+STREAM_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+CACHE_AUDIO_FORMAT = "opus"
+OPUS_PASSTHROUGH = True
+OPUS_EXTENSIONS = (".opus",)
+VOLUME_RESTART_DELAY = 0.3
+GAPLESS_PRELOAD_SECONDS = 5  # Open the next track this long before the current one ends
+GAPLESS_PRIME_FRAMES = 25  # 20ms frames read ahead from the next track so it starts without a gap
+CROSSFADE_SECONDS = 0  # Overlap between consecutive tracks; 0 switches straight over
+REAP_TIMEOUT = 2.0  # Seconds a child process gets to exit after being asked before it is killed
+PROCESS_STATS_MAX_AGE = 1.0  # Readers within this many seconds share one measurement, so CPU is never taken over a shorter span
+POSTPROCESS_POLL_INTERVAL = 0.5  # How often the bot looks for yt-dlp's FFmpeg while a download is being converted
+JANITOR_RETRIES = 3  # Attempts at deleting a file that is still held open, e.g. by an FFmpeg that is exiting
+JANITOR_RETRY_DELAY = 0.5
+JANITOR_SHUTDOWN_TIMEOUT = 10.0  # Longest the bot waits on exit for the temp folder to be emptied
+LOUDNESS_NORMALIZATION = True  # Measure cached songs once and play them all at the same loudness
+LOUDNESS_TARGET_LUFS = -16.0
+LOUDNESS_MAX_TRUE_PEAK = -1.0  # Gain is limited so a song's peaks stay below this (dBTP)
+LOUDNESS_MAX_GAIN_DB = 12.0
+LOUDNESS_TOLERANCE_DB = 1.0  # Smaller corrections are skipped so Opus songs can still be passed through untouched
+MAX_LAYER_GAIN = 10 ** (LOUDNESS_MAX_GAIN_DB / 20)  # Highest gain the mixer gives a layer, so the largest loudness correction fits
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # Histogram bounds in seconds
+METRICS_RECENT_SAMPLES = 500  # Samples kept per histogram for the percentiles in !stats
+METRICS_REFRESH_MS = 2000  # How often the window's stats panel updates
+LOOP_LAG_INTERVAL = 1.0
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None  # Set to a port number to serve Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics
+CONTROL_HOST = "127.0.0.1"  # The control API has no other protection than CONTROL_TOKEN, keep it local
+CONTROL_HOST_NAMES = ("127.0.0.1", "localhost")  # Host headers the control API answers to, so a web page cannot rebind its DNS name to it
+CONTROL_PORT = 8765  # Port of the control API with --headless; the window gets a free port of its own
+CONTROL_TOKEN = None  # Set to require "Authorization: Bearer <token>" on every control API request; the window always uses a random one
+CONTROL_POLL_TIMEOUT = 25  # Longest a GET /state?since=N waits for a change before answering anyway
+CONTROL_COALESCE_SECONDS = 0.05  # A change is answered this long after it happens so a burst goes out as one state
+CONTROL_CALL_TIMEOUT = 30
+AUDIO_WORKERS = 0  # Processes that decode, mix and encode the voice streams; 0 does it in the bot process
+AUDIO_WORKER_TIMEOUT = 1.0  # Longest a frame may take in a worker before the worker is given up on
+AUDIO_WORKER_START_TIMEOUT = 15.0  # Allowance for the first frame, which waits for the worker to start up
+OPUS_SILENCE = b'\xf8\xff\xfe'
+OPUS_HEADER_PACKETS = (b"OpusHead", b"OpusTags")  # Ogg header packets an Opus music source starts with; they hold no audio
+COMMAND_SYNC_FILE = os.path.join(CACHE_DIR, "commands.json")  # Fingerprint of the slash commands last sent to Discord
+AUTOCOMPLETE_LIMIT = 25  # Most suggestions Discord shows for an option
+SESSION_FILE = os.path.join(CACHE_DIR, "sessions.json")  # Queues and positions the bot picks up again after a restart
+SESSION_SNAPSHOT_INTERVAL = 5.0  # Seconds between snapshots; a crash loses at most this much of the position
+SESSION_MAX_AGE = 24 * 60 * 60  # Older snapshots are not resumed
+RESUME_SESSIONS = True
+LIBRARY_DIRS = []  # Folders of your own music, e.g. ["C:/Music"]; !play looks here before searching YouTube
+LIBRARY_INDEX_FILE = os.path.join(CACHE_DIR, "library.json")
+LIBRARY_EXTENSIONS = (".mp3", ".flac", ".ogg", ".opus", ".m4a", ".aac", ".wav", ".wma", ".webm")
+LIBRARY_MIN_SCORE = 0.75  # Share of a song's title words a request must match for it to be played from the library
+LIBRARY_FUZZY_CUTOFF = 0.8  # How close a misspelt word must be to a known one (0-1)
 
 # Global variables
-vc = None
-file_queue = Queue(maxsize=50)
-paused_file = None
-paused_position = 0
-current_file = None
-start_time = None
 music_volume = 1.0
 quick_sound_volume = 1.0
-vc_lock = asyncio.Lock()
-is_playing_quick_sound = False
-youtube_cache = OrderedDict()
+players = {}
+player_listeners = []
 
 # Ensure temp directory exists
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# Metrics
+METRIC_DESCRIPTIONS = {
+    'search_seconds': ("histogram", "Time taken by YouTube searches."),
+    'download_seconds': ("histogram", "Time taken to download a song's audio."),
+    'transcode_seconds': ("histogram", "Time taken by FFmpeg to convert a download into the cache format."),
+    'loudness_seconds': ("histogram", "Time taken to measure a cached song's loudness."),
+    'time_to_first_audio_seconds': ("histogram", "Time from a request on an idle player to its first audio frame."),
+    'loop_lag_seconds': ("histogram", "How late the event loop wakes up from a sleep."),
+    'cache_lookups_total': ("counter", "Cache lookups by layer and result."),
+    'queue_depth': ("gauge", "Songs waiting in each guild's queue."),
+    'ffmpeg_processes': ("gauge", "FFmpeg processes the bot is running."),
+    'ffmpeg_rss_bytes': ("gauge", "Memory used by the bot's FFmpeg processes."),
+}
+
+class Histogram:
+    # Initializes a histogram with cumulative buckets and a window of recent samples for percentiles.
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=METRICS_RECENT_SAMPLES)
+
+    # Records one sample.
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    # Returns the q-th percentile (0-1) of the recent samples, or None if there are none.
+    def percentile(self, q):
+        if not self.recent:
+            return None
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+class MetricsRegistry:
+    # Initializes an empty registry of counters, histograms and gauges read on demand.
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    # Adds to a counter. labels is a dict such as {'layer': "audio", 'result': "hit"}.
+    def inc(self, name, labels=None, amount=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    # Records a sample in a histogram.
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    # Records how long the with block takes in a histogram.
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    # Registers a gauge. read returns a number, or a dict of label tuples to numbers.
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    # Returns the current value of every gauge as a dict of label tuples to numbers.
+    def read_gauges(self):
+        values = {}
+        for name, read in self.gauges.items():
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning(f"Failed to read gauge {name}: {e}")
+                continue
+            values[name] = value if isinstance(value, dict) else {(): value}
+        return values
+
+    # Returns the total of a counter across label values, optionally only those matching labels.
+    def counter(self, name, labels=None):
+        wanted = set((labels or {}).items())
+        with self.lock:
+            return sum(value for (key, key_labels), value in self.counters.items() if key == name and wanted <= set(key_labels))
+
+    # Returns a short human-readable report, one line per topic.
+    def summary_lines(self):
+        lines = []
+        with self.lock:
+            histograms = {name: (h.count, h.percentile(0.5), h.percentile(0.95)) for name, h in self.histograms.items()}
+        for name, label in (('time_to_first_audio_seconds', "Time to first audio"), ('search_seconds', "Search"),
+                            ('download_seconds', "Download"), ('transcode_seconds', "Transcode"),
+                            ('loop_lag_seconds', "Loop lag")):
+            if name in histograms and histograms[name][0]:
+                count, p50, p95 = histograms[name]
+                lines.append(f"{label}: p50 {p50 * 1000:.0f} ms, p95 {p95 * 1000:.0f} ms ({count})")
+        caches = []
+        for layer in ("resolution", "audio", "soundboard"):
+            hits = self.counter('cache_lookups_total', {'layer': layer, 'result': "hit"})
+            misses = self.counter('cache_lookups_total', {'layer': layer, 'result': "miss"})
+            if hits or misses:
+                caches.append(f"{layer} {hits}/{hits + misses}")
+        if caches:
+            lines.append("Cache hits: " + ", ".join(caches))
+        gauges = self.read_gauges()
+        lines.append(f"Queued songs: {sum(gauges.get('queue_depth', {}).values())}, "
+                     f"FFmpeg processes: {sum(gauges.get('ffmpeg_processes', {}).values())} "
+                     f"({sum(gauges.get('ffmpeg_rss_bytes', {}).values()) / 1048576:.0f} MiB)")
+        return lines
+
+    # Returns every metric in the Prometheus text format.
+    def render_prometheus(self):
+        out = []
+
+        # Formats a label tuple as {name="value",...}.
+        def fmt(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        # Writes the HELP and TYPE lines for a metric.
+        def header(name):
+            kind, text = METRIC_DESCRIPTIONS.get(name, ("untyped", name))
+            out.append(f"# HELP musicbot_{name} {text}")
+            out.append(f"# TYPE musicbot_{name} {kind}")
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: (h.buckets, list(h.counts), h.sum, h.count) for name, h in self.histograms.items()}
+        for name in sorted({name for name, _ in counters}):
+            header(name)
+            for (key, labels), value in sorted(counters.items()):
+                if key == name:
+                    out.append(f"musicbot_{name}{fmt(labels)} {value}")
+        for name, (buckets, counts, total, count) in sorted(histograms.items()):
+            header(name)
+            for bound, bucket_count in zip(buckets, counts):
+                out.append(f'musicbot_{name}_bucket{{le="{bound}"}} {bucket_count}')
+            out.append(f'musicbot_{name}_bucket{{le="+Inf"}} {count}')
+            out.append(f"musicbot_{name}_sum {total}")
+            out.append(f"musicbot_{name}_count {count}")
+        for name, values in sorted(self.read_gauges().items()):
+            header(name)
+            for labels, value in sorted(values.items()):
+                out.append(f"musicbot_{name}{fmt(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = MetricsRegistry()
+metrics.gauge('queue_depth', lambda: {(('guild', str(guild_id)),): len(player.playlist) for guild_id, player in list(players.items())})
+# Both FFmpeg gauges are read from one process_supervisor.stats() measurement per collection
+metrics.gauge('ffmpeg_processes', lambda: len(process_supervisor.stats()))
+metrics.gauge('ffmpeg_rss_bytes', lambda: sum(row['rss'] for row in process_supervisor.stats()))
+
+# Measures how late the event loop wakes up from a sleep, i.e. how long ready callbacks wait to run.
+async def monitor_loop_lag():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe('loop_lag_seconds', max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+# Serves the metrics to Prometheus.
+class MetricsHandler(BaseHTTPRequestHandler):
+    # Answers GET /metrics with the current metrics.
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keeps scrapes out of the bot's log.
+    def log_message(self, format, *args):
+        pass
+
+# Starts the Prometheus endpoint in a background thread if METRICS_PORT is set.
+def start_metrics_server():
+    if METRICS_PORT is None:
+        return None
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        logger.error(f"Failed to start metrics endpoint on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return server
+
 # Utility Functions
 # Loads quick play sound mappings from a file and returns them as a dictionary.
 def load_quick_play_files():
@@ -69,521 +390,3395 @@ def save_quick_play_file(name, file_path):
     with open(QUICK_PLAY_FILE, "w", encoding='utf-8') as f:
         f.writelines(f"{n}:{p}\n" for n, p in quick_play_files.items())
 
-# Downloads a song from YouTube, caches it, and returns the file path and title.
-def download_song(song_title):
-    cache_key = song_title.lower()
-    if cache_key in youtube_cache and os.path.exists(youtube_cache[cache_key]):
-        logger.info(f"Cache hit for {song_title}")
-        youtube_cache.move_to_end(cache_key)
-        return youtube_cache[cache_key], song_title
-
+# Splits an optional leading --stream/--download flag off a !play argument and returns (mode, song_title).
+def parse_play_mode(song_title):
+    flag, _, rest = song_title.strip().partition(" ")
+    if flag.lower() in PLAY_MODE_FLAGS and rest.strip():
+        return PLAY_MODE_FLAGS[flag.lower()], rest.strip()
+    return DEFAULT_PLAY_MODE, song_title
+
+# Resolves a query to a video through the resolution cache, searching YouTube only on a miss.
+def resolve_song(song_title):
+    video_id = video_id_from_url(song_title)
+    title = audio_cache.title(video_id) if video_id else None
+    if title:
+        return {'id': video_id, 'title': title}
+    video = resolution_cache.get(song_title)
+    if video:
+        logger.info(f"Resolution cache hit for {song_title}")
+        return video
+    video = search_song(song_title)
+    if video:
+        resolution_cache.put(song_title, video)
+    return video
+
+# Returns True if a resolved stream URL is still safely inside its expiry window.
+def stream_url_valid(video):
+    url = video.get('url')
+    if not url:
+        return False
+    expire = parse_qs(urlparse(url).query).get('expire')
+    return not expire or int(expire[0]) - STREAM_URL_EXPIRY_MARGIN > time.time()
+
+# Fetches fresh stream info (direct audio URL and codec) for a known video ID.
+def fetch_stream_info(video_id):
+    with yt_dlp.YoutubeDL({'format': 'bestaudio', 'quiet': True}) as ydl:
+        info = ydl.extract_info(f'https://www.youtube.com/watch?v={video_id}', download=False)
+    return info or {}
+
+# Searches YouTube and returns the info dict of the first result, or None if nothing was found.
+# A video link is looked up directly rather than searched for.
+def search_song(song_title):
+    ydl_search_opts = {
+        'format': 'bestaudio',
+        'noplaylist': True,
+        'quiet': True,
+        'default_search': 'ytsearch',
+    }
+    with metrics.timer('search_seconds'), yt_dlp.YoutubeDL(ydl_search_opts) as ydl:
+        info = ydl.extract_info(song_title, download=False)
+    if info and 'entries' not in info and info.get('id'):
+        return info
+    if not info or 'entries' not in info or not info['entries']:
+        return None
+    return info['entries'][0]
+
+# Returns True if a request is a link to a YouTube playlist rather than to a single video or a search.
+# A video link that also carries a playlist ID plays just that video.
+def is_playlist_url(query):
+    parsed = urlparse(query.strip())
+    if parsed.scheme not in ("http", "https"):
+        return False
+    params = parse_qs(parsed.query)
+    return 'list' in params and (parsed.path.rstrip("/") == "/playlist" or 'v' not in params)
+
+# Returns the link to a YouTube video.
+def video_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+# Returns the video ID of a link to a single YouTube video, or None for anything else.
+def video_id_from_url(query):
+    parsed = urlparse(query.strip())
+    if parsed.scheme not in ("http", "https"):
+        return None
+    host = parsed.netloc.lower().removeprefix("www.").removeprefix("m.").removeprefix("music.")
+    if host == "youtu.be":
+        return parsed.path.strip("/") or None
+    if host == "youtube.com" and parsed.path.rstrip("/") == "/watch":
+        return parse_qs(parsed.query).get('v', [None])[0]
+    return None
+
+# Lists up to limit entries of a playlist without resolving any of them, fetching only the pages
+# needed. Returns the playlist title and a list of entry dicts with id, title and duration.
+def fetch_playlist(url, limit):
+    ydl_playlist_opts = {
+        'extract_flat': 'in_playlist',
+        'lazy_playlist': True,
+        'playlistend': limit,
+        'quiet': True,
+    }
+    with yt_dlp.YoutubeDL(ydl_playlist_opts) as ydl:
+        info = ydl.extract_info(url, download=False) or {}
+        entries = [entry for entry in itertools.islice(info.get('entries') or [], limit) if entry and entry.get('id')]
+    return info.get('title') or url, entries
+
+# Resolves a song to a direct audio stream URL, preferring an already cached file. Returns a Track and a message.
+def resolve_stream(song_title):
     try:
-        for file in os.listdir(TEMP_DIR):
-            file_path = os.path.join(TEMP_DIR, file)
-            if file_path not in youtube_cache.values() and file.endswith('.mp3'):
-                try:
-                    os.remove(file_path)
-                except OSError as e:
-                    logger.warning(f"Failed to remove {file_path}: {e}")
+        video = resolve_song(song_title)
+        if not video:
+            return None, "No video found."
+        cached_path = audio_cache.get(video['id'])
+        if cached_path:
+            logger.info(f"Cache hit for {song_title}")
+            return Track(cached_path, video['title'], video['id'], duration=video.get('duration')), video['title']
+        if not stream_url_valid(video):
+            video.update({key: value for key, value in fetch_stream_info(video['id']).items() if key in ('url', 'acodec')})
+        if not video.get('url'):
+            return None, "No audio stream found."
+        track = Track(video['url'], video['title'], video['id'], is_stream=True, codec=video.get('acodec'), duration=video.get('duration'))
+        return track, video['title']
+    except Exception as e:
+        logger.error(f"Stream resolve error for {song_title}: {e}")
+        return None, f"Error resolving stream: {e}"
 
-        ydl_search_opts = {
-            'format': 'bestaudio',
-            'noplaylist': True,
-            'quiet': True,
-            'default_search': 'ytsearch',
-        }
-        with YoutubeDL(ydl_search_opts) as ydl:
-            info = ydl.extract_info(song_title, download=False)
-            if not info or 'entries' not in info or not info['entries']:
+# Downloads a song from YouTube, caches it, and returns the file path and title.
+# If the search result is already known it can be passed as video to skip the search,
+# and setting cancel_event aborts the download at the next progress update.
+def download_song(song_title, video=None, cancel_event=None):
+    try:
+        if video is None:
+            video = resolve_song(song_title)
+            if not video:
                 return None, "No video found."
-            video = info['entries'][0]
-            video_id, title = video['id'], video['title']
-            base_url = f'https://www.youtube.com/watch?v={video_id}'
-
-        safe_title = "".join(c if c.isalnum() or c in " -_()" else "_" for c in title)
-        file_path = os.path.join(TEMP_DIR, f"{safe_title}")
+        video_id, title = video['id'], video['title']
+        cached_path = audio_cache.get(video_id)
+        if cached_path:
+            logger.info(f"Cache hit for {song_title}")
+            return cached_path, title
+
+        timings = {'download': time.monotonic()}
+        finished = {}
+        watchers = []
+
+        # Raises inside yt-dlp's progress callback to abort a cancelled download, times the download
+        # and tells the janitor which files it is writing.
+        def check_cancelled(progress):
+            if cancel_event is not None and cancel_event.is_set():
+                raise yt_dlp.utils.DownloadCancelled("Download cancelled.")
+            for key in ('tmpfilename', 'filename'):
+                if progress.get(key):
+                    janitor.track(progress[key])
+            if progress.get('status') == "finished":
+                metrics.observe('download_seconds', time.monotonic() - timings['download'])
+
+        # Times FFmpeg's conversion of the download into the cache format, has the supervisor pick up
+        # the FFmpeg yt-dlp starts for it and records the file it produced.
+        def time_postprocessing(progress):
+            if progress.get('status') == "started":
+                timings['transcode'] = time.monotonic()
+                watchers.append(process_supervisor.watch_children(song_title))
+            elif progress.get('status') == "finished":
+                if watchers:
+                    watchers[-1].set()
+                if 'transcode' in timings:
+                    metrics.observe('transcode_seconds', time.monotonic() - timings.pop('transcode'))
+                filepath = (progress.get('info_dict') or {}).get('filepath')
+                if filepath:
+                    janitor.track(filepath)
+                    finished['path'] = filepath
+
+        # In opus mode YouTube's Opus track is remuxed into an .opus file without re-encoding.
+        base_url = f'https://www.youtube.com/watch?v={video_id}'
+        file_path = os.path.join(TEMP_DIR, video_id)
         ydl_download_opts = {
-            'format': 'bestaudio',
+            'format': 'bestaudio[acodec=opus]/bestaudio' if CACHE_AUDIO_FORMAT == "opus" else 'bestaudio',
             'outtmpl': file_path,
-            'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3'}],
+            'postprocessors': [{'key': 'FFmpegExtractAudio', 'preferredcodec': CACHE_AUDIO_FORMAT}],
+            'progress_hooks': [check_cancelled],
+            'postprocessor_hooks': [time_postprocessing],
             'quiet': True,
         }
-        with YoutubeDL(ydl_download_opts) as ydl:
-            ydl.download([base_url])
-
-        time.sleep(0.2)
-        expected_file = f"{file_path}.mp3"
-        if os.path.exists(expected_file):
-            if len(youtube_cache) >= MAX_CACHE_SIZE:
-                oldest_key = next(iter(youtube_cache))
-                try:
-                    os.remove(youtube_cache[oldest_key])
-                except OSError as e:
-                    logger.warning(f"Failed to remove cached file {youtube_cache[oldest_key]}: {e}")
-                del youtube_cache[oldest_key]
-            youtube_cache[cache_key] = expected_file
-            return expected_file, title
-
-        mp3_files = [f for f in os.listdir(TEMP_DIR) if f.endswith('.mp3') and safe_title in f]
-        if mp3_files:
-            found_file = os.path.join(TEMP_DIR, mp3_files[0])
-            youtube_cache[cache_key] = found_file
-            return found_file, title
-
-        logger.error(f"Download failed: No matching .mp3 found for {song_title} in {TEMP_DIR}")
+        with janitor.claim(video_id), yt_dlp.YoutubeDL(ydl_download_opts) as ydl:
+            try:
+                ydl.download([base_url])
+            finally:
+                for watcher in watchers:
+                    watcher.set()
+            # yt-dlp reports the converted file; the janitor's list covers a post-processor that did not
+            candidates = [finished.get('path'), f"{file_path}.{CACHE_AUDIO_FORMAT}"]
+            candidates += [path for path in janitor.files_for(video_id) if path.endswith(CACHE_AUDIO_EXTENSIONS)]
+            audio_file = next((path for path in candidates if path and os.path.exists(path)), None)
+            if audio_file:
+                cached_path = audio_cache.add(video_id, audio_file, title)
+                janitor.forget(audio_file)
+                schedule_loudness_analysis(video_id)
+                return cached_path, title
+
+        logger.error(f"Download failed: No matching audio file found for {song_title} in {TEMP_DIR}")
         return None, "Failed to download."
+    except yt_dlp.utils.DownloadCancelled:
+        logger.info(f"Download cancelled for {song_title}")
+        janitor.discard(video['id'])
+        return None, "Cancelled."
     except Exception as e:
         logger.error(f"Download error for {song_title}: {e}")
         return None, f"Error downloading: {e}"
 
-# Terminates all running FFmpeg processes to release file handles.
-def terminate_ffmpeg_processes():
-    for proc in psutil.process_iter(['pid', 'name']):
-        if 'ffmpeg' in proc.info['name'].lower():
+# Process Supervisor
+class ProcessSupervisor:
+    # Initializes a registry of the FFmpeg processes the bot started, directly or through yt-dlp.
+    def __init__(self):
+        self.processes = {}
+        self.lock = threading.Lock()
+        self.last_stats = (0.0, [])
+
+    # Registers a child process with the guild it works for (None for shared work) and a description.
+    def register(self, popen, owner=None, label="", kind="ffmpeg"):
+        try:
+            process = psutil.Process(popen.pid)
+            process.cpu_percent(None)
+        except psutil.Error:
+            return
+        with self.lock:
+            self._prune()
+            self.processes[popen.pid] = {
+                'popen': popen, 'process': process, 'owner': owner, 'label': label,
+                'kind': kind, 'started': time.time(), 'peak_rss': 0,
+            }
+
+    # Registers the FFmpeg process behind a discord.py audio source and returns the source.
+    def track(self, source, owner=None, label=""):
+        popen = getattr(source, '_process', None)
+        if popen is not None:
+            self.register(popen, owner, label)
+        return source
+
+    # Registers FFmpeg processes yt-dlp started for post-processing, which it does not hand back.
+    # Only looks at the bot's direct children.
+    def discover(self, label="post-processing"):
+        with self.lock:
+            self._prune()
+            known = set(self.processes)
+        for pid in self._child_pids():
+            if pid in known:
+                continue
+            try:
+                child = psutil.Process(pid)
+                if 'ffmpeg' not in child.name().lower():
+                    continue
+                child.cpu_percent(None)
+            except psutil.Error:
+                continue
+            with self.lock:
+                self.processes.setdefault(pid, {
+                    'popen': None, 'process': child, 'owner': None, 'label': label,
+                    'kind': "yt-dlp", 'started': time.time(), 'peak_rss': 0,
+                })
+
+    # Looks for the FFmpeg of a yt-dlp post-processing step every POSTPROCESS_POLL_INTERVAL seconds
+    # until the returned event is set, so the host's process list is only read while one is running.
+    def watch_children(self, label):
+        stop = threading.Event()
+
+        # Polls for new children until stopped.
+        def watch():
+            while not stop.wait(POSTPROCESS_POLL_INTERVAL):
+                self.discover(label)
+
+        threading.Thread(target=watch, name="postprocess-watch", daemon=True).start()
+        return stop
+
+    # Returns the PIDs of the bot's direct children. Linux lists them per thread in /proc; elsewhere,
+    # or on kernels without that file, psutil has to go through every process on the host.
+    @staticmethod
+    def _child_pids():
+        pids = set()
+        if os.path.exists(f"/proc/self/task/{os.getpid()}/children"):
+            for task in os.listdir("/proc/self/task"):
+                try:
+                    with open(f"/proc/self/task/{task}/children", "r") as f:
+                        pids.update(int(pid) for pid in f.read().split())
+                except OSError:
+                    continue
+            return pids
+        try:
+            return {child.pid for child in psutil.Process().children()}
+        except psutil.Error:
+            return pids
+
+    # Returns the PIDs of the registered processes working for a guild.
+    def owned_by(self, owner):
+        with self.lock:
+            return [pid for pid, entry in self.processes.items() if entry['owner'] == owner]
+
+    # Returns CPU and memory figures for every registered process still running, forgetting the ones
+    # that exited. A measurement less than max_age seconds old is returned again rather than redone:
+    # psutil's CPU figure covers the time since the previous reading, which a second reader would cut short.
+    def stats(self, max_age=PROCESS_STATS_MAX_AGE):
+        with self.lock:
+            measured_at, rows = self.last_stats
+            if time.monotonic() - measured_at < max_age:
+                return list(rows)
+            entries = list(self.processes.items())
+        rows = []
+        now = time.time()
+        for pid, entry in entries:
+            try:
+                if not self._alive(entry):
+                    raise psutil.NoSuchProcess(pid)
+                with entry['process'].oneshot():
+                    cpu = entry['process'].cpu_percent(None)
+                    rss = entry['process'].memory_info().rss
+            except psutil.Error:
+                with self.lock:
+                    if self.processes.get(pid) is entry:
+                        del self.processes[pid]
+                continue
+            entry['peak_rss'] = max(entry['peak_rss'], rss)
+            rows.append({
+                'pid': pid, 'kind': entry['kind'], 'owner': entry['owner'], 'label': entry['label'],
+                'cpu': cpu, 'rss': rss, 'peak_rss': entry['peak_rss'], 'age': now - entry['started'],
+            })
+        with self.lock:
+            self.last_stats = (time.monotonic(), rows)
+        return list(rows)
+
+    # Stops the given processes, or every child the bot started when pids is None, and waits for
+    # each to exit, killing any still running after timeout. Blocking.
+    def reap(self, pids=None, timeout=REAP_TIMEOUT):
+        if pids is None:
+            self.discover()
+        with self.lock:
+            pids = list(self.processes) if pids is None else pids
+            entries = [self.processes.pop(pid) for pid in pids if pid in self.processes]
+        for entry in entries:
             try:
-                proc.kill()
-                logger.info(f"Terminated FFmpeg process with PID {proc.info['pid']}")
-            except psutil.NoSuchProcess:
+                if entry['popen'] is not None:
+                    entry['popen'].terminate()
+                else:
+                    entry['process'].terminate()
+            except (OSError, psutil.Error):
                 pass
+        deadline = time.monotonic() + timeout
+        for entry in entries:
+            remaining = max(0, deadline - time.monotonic())
+            try:
+                if entry['popen'] is not None:
+                    try:
+                        entry['popen'].wait(remaining)
+                    except subprocess.TimeoutExpired:
+                        entry['popen'].kill()
+                        entry['popen'].wait()
+                else:
+                    try:
+                        entry['process'].wait(remaining)
+                    except psutil.TimeoutExpired:
+                        entry['process'].kill()
+                        entry['process'].wait()
+            except (OSError, psutil.Error):
+                pass
+        if entries:
+            logger.info(f"Reaped {len(entries)} FFmpeg process(es).")
+
+    # Forgets the registered processes that have exited, waiting on those the bot started itself, so
+    # the registry only holds running ones even if the stats are never read and a reused PID is seen
+    # as new. Must be called with the lock held.
+    def _prune(self):
+        for pid in [pid for pid, entry in self.processes.items() if not self._alive(entry)]:
+            del self.processes[pid]
+
+    # Returns True if a registered process has not exited yet.
+    @staticmethod
+    def _alive(entry):
+        if entry['popen'] is not None:
+            return entry['popen'].poll() is None
+        try:
+            return entry['process'].is_running() and entry['process'].status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+process_supervisor = ProcessSupervisor()
+
+# Janitor
+class Janitor:
+    # Initializes the janitor of the temp folder. Deleting is done on its own worker thread, and it
+    # keeps a list of the temp files it has been told about so callers never scan the folder.
+    def __init__(self, temp_dir):
+        self.temp_dir = temp_dir
+        self.files = set()
+        self.claims = {}
+        self.failed = set()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="janitor")
+
+    # Makes sure the temp folder exists and clears out what a previous run left in it, in the background.
+    def start(self):
+        os.makedirs(self.temp_dir, exist_ok=True)
+        return self.sweep()
+
+    # Records a file that has appeared in the temp folder.
+    def track(self, path):
+        with self.lock:
+            self.files.add(path)
+
+    # Forgets a file that was moved out of the temp folder.
+    def forget(self, path):
+        with self.lock:
+            self.files.discard(path)
+
+    # Returns the known temp files whose names start with prefix.
+    def files_for(self, prefix):
+        with self.lock:
+            return [path for path in self.files if os.path.basename(path).startswith(prefix)]
+
+    # Marks a download's files (those starting with prefix) as in use, so sweeps leave them alone.
+    # When the claim ends, files yt-dlp has since removed itself, like .part files, are forgotten.
+    @contextlib.contextmanager
+    def claim(self, prefix):
+        with self.lock:
+            self.claims[prefix] = self.claims.get(prefix, 0) + 1
+        try:
+            yield
+        finally:
+            gone = [path for path in self.files_for(prefix) if not os.path.exists(path)]
+            with self.lock:
+                self.files.difference_update(gone)
+                self.claims[prefix] -= 1
+                if not self.claims[prefix]:
+                    del self.claims[prefix]
+
+    # Deletes files in the background. Returns a future that is done once they are gone.
+    def delete(self, *paths):
+        with self.lock:
+            self.files.difference_update(paths)
+        return self.executor.submit(self._delete, paths)
+
+    # Deletes every temp file of a download in the background, e.g. the partial files of a cancelled one.
+    def discard(self, prefix):
+        return self.executor.submit(self._discard, prefix)
+
+    # Empties the temp folder in the background, leaving the files of running downloads, and retries
+    # deletions that failed before. With reap set the bot's FFmpeg processes are stopped first so none
+    # of them still has a file open. Returns a future that is done once the sweep is.
+    def sweep(self, reap=False):
+        return self.executor.submit(self._sweep, reap)
+
+    # Empties the temp folder one last time, waiting up to timeout, and stops the worker.
+    def shutdown(self, timeout=JANITOR_SHUTDOWN_TIMEOUT):
+        try:
+            self.sweep().result(timeout)
+        except Exception as e:
+            logger.warning(f"Temp folder cleanup did not finish: {e}")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Deletes files. Runs on the worker.
+    def _delete(self, paths, attempts=1):
+        for path in paths:
+            self._remove(path, attempts)
+
+    # Deletes one file or folder, retrying while it is in use. Returns True once it is gone. Runs on the worker.
+    def _remove(self, path, attempts=1):
+        for attempt in range(attempts):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                if attempt + 1 < attempts:
+                    time.sleep(JANITOR_RETRY_DELAY)
+                    continue
+                logger.warning(f"Failed to remove {path}, will try again on the next sweep: {e}")
+                with self.lock:
+                    self.failed.add(path)
+                return False
+            with self.lock:
+                self.failed.discard(path)
+                self.files.discard(path)
+            return True
+        return False
+
+    # Deletes a download's files, including any yt-dlp made without reporting them. Files a running
+    # download has claimed are left alone. Runs on the worker.
+    def _discard(self, prefix):
+        paths = set(self.files_for(prefix))
+        paths.update(entry.path for entry in self._scan() if entry.name.startswith(prefix))
+        self._delete([path for path in paths if not self._claimed(os.path.basename(path))])
+
+    # Returns True if a file name belongs to a running download.
+    def _claimed(self, name):
+        with self.lock:
+            return any(name.startswith(prefix) for prefix in self.claims)
+
+    # Empties the temp folder. Runs on the worker.
+    def _sweep(self, reap):
+        if reap:
+            process_supervisor.reap()
+        with self.lock:
+            retry = list(self.failed)
+        self._delete(retry, JANITOR_RETRIES)
+        removed = 0
+        for entry in self._scan():
+            if not self._claimed(entry.name) and self._remove(entry.path, JANITOR_RETRIES):
+                removed += 1
+        if removed:
+            logger.info(f"Cleared {removed} file(s) from the temp folder.")
+
+    # Lists the temp folder, recreating it if it has gone. Runs on the worker.
+    def _scan(self):
+        try:
+            with os.scandir(self.temp_dir) as entries:
+                return list(entries)
+        except FileNotFoundError:
+            os.makedirs(self.temp_dir, exist_ok=True)
+            return []
+
+janitor = Janitor(TEMP_DIR)
+
+# Audio Cache
+class AudioCache:
+    # Initializes a cache of downloaded audio keyed by YouTube video ID, bounded by a byte budget.
+    def __init__(self, cache_dir, max_bytes, policy="lru"):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, CACHE_INDEX_NAME)
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = {}
+        self.total_bytes = 0
+        self.loaded = False
+        self.dirty = False
+        self.save_timer = None
+        self.lock = threading.RLock()
+
+    # Loads the on-disk index, dropping entries whose files are gone and deleting audio files the index does not know.
+    def load(self):
+        with self.lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            entries = {}
+            try:
+                with open(self.index_file, "r", encoding='utf-8') as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to read cache index {self.index_file}, starting empty: {e}")
+
+            self.entries = {}
+            for video_id, entry in entries.items():
+                path = os.path.join(self.cache_dir, entry.get('file', ''))
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    logger.info(f"Cache entry {video_id} is missing its file, dropping it.")
+                    continue
+                if size != entry.get('size'):
+                    logger.info(f"Cache entry {video_id} has a damaged file, dropping it.")
+                    janitor.delete(path)
+                    continue
+                self.entries[video_id] = entry
+
+            known_files = {entry['file'] for entry in self.entries.values()}
+            orphans = [file for file in os.listdir(self.cache_dir) if file.endswith(CACHE_AUDIO_EXTENSIONS) and file not in known_files]
+            janitor.delete(*(os.path.join(self.cache_dir, file) for file in orphans))
+
+            self.total_bytes = sum(entry['size'] for entry in self.entries.values())
+            self.loaded = True
+            self._evict()
+            self._save()
+            logger.info(f"Audio cache loaded: {len(self.entries)} track(s), {self.total_bytes / 1048576:.1f} MiB")
+
+    # Returns the cached file path for a video ID and records the hit, or None on a miss.
+    def get(self, video_id):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            entry = self.entries.get(video_id)
+            if not entry:
+                metrics.inc('cache_lookups_total', {'layer': "audio", 'result': "miss"})
+                return None
+            path = os.path.join(self.cache_dir, entry['file'])
+            if not os.path.exists(path):
+                self._drop(video_id)
+                self._save()
+                metrics.inc('cache_lookups_total', {'layer': "audio", 'result': "miss"})
+                return None
+            entry['last_used'] = time.time()
+            entry['hits'] = entry.get('hits', 0) + 1
+            self._save_later()
+            metrics.inc('cache_lookups_total', {'layer': "audio", 'result': "hit"})
+            return path
+
+    # Returns the cached title for a video ID, or None if it is not cached.
+    def title(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return entry['title'] if entry else None
+
+    # Returns the cached file path for a video ID without counting it as a play, or None on a miss.
+    def path(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            return os.path.join(self.cache_dir, entry['file']) if entry else None
+
+    # Stores the loudness measured for a cached track.
+    def set_loudness(self, video_id, loudness):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry:
+                entry['loudness'] = loudness
+                self._save()
+
+    # Returns the video ID and title of every cached track, most recently played first.
+    def titles(self):
+        with self.lock:
+            entries = sorted(self.entries.items(), key=lambda item: item[1].get('last_used', 0), reverse=True)
+            return [(video_id, entry['title']) for video_id, entry in entries]
+
+    # Returns the video IDs of cached tracks whose loudness has not been measured yet.
+    def unmeasured(self):
+        with self.lock:
+            return [video_id for video_id, entry in self.entries.items() if 'loudness' not in entry]
+
+    # Returns the linear gain that brings a cached track to LOUDNESS_TARGET_LUFS without pushing its
+    # peaks past LOUDNESS_MAX_TRUE_PEAK, or 1.0 if it is not measured or already close enough.
+    def gain(self, video_id):
+        with self.lock:
+            entry = self.entries.get(video_id)
+            loudness = entry.get('loudness') if entry else None
+        if not LOUDNESS_NORMALIZATION or not loudness or loudness.get('integrated') is None:
+            return 1.0
+        gain_db = LOUDNESS_TARGET_LUFS - loudness['integrated']
+        if loudness.get('true_peak') is not None:
+            gain_db = min(gain_db, LOUDNESS_MAX_TRUE_PEAK - loudness['true_peak'])
+        gain_db = max(-LOUDNESS_MAX_GAIN_DB, min(gain_db, LOUDNESS_MAX_GAIN_DB))
+        if abs(gain_db) < LOUDNESS_TOLERANCE_DB:
+            return 1.0
+        return 10 ** (gain_db / 20)
+
+    # Moves a finished download into the cache, evicts down to the byte budget and returns the cached path.
+    def add(self, video_id, file_path, title):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            file_name = f"{video_id}{os.path.splitext(file_path)[1]}"
+            cached_path = os.path.join(self.cache_dir, file_name)
+            if video_id in self.entries:
+                self._drop(video_id)
+            os.replace(file_path, cached_path)
+            size = os.path.getsize(cached_path)
+            self.entries[video_id] = {'file': file_name, 'title': title, 'size': size, 'last_used': time.time(), 'hits': 0}
+            self.total_bytes += size
+            self._evict(keep=video_id)
+            self._save()
+            return cached_path
+
+    # Evicts entries by the configured policy until the cache fits its byte budget. The files are
+    # deleted by the janitor; one still in use is retried on its next sweep, or dropped as an orphan on the next load.
+    def _evict(self, keep=None):
+        if self.total_bytes <= self.max_bytes:
+            return
+        if self.policy == "lfu":
+            order = sorted(self.entries, key=lambda v: (self.entries[v].get('hits', 0), self.entries[v]['last_used']))
+        else:
+            order = sorted(self.entries, key=lambda v: self.entries[v]['last_used'])
+        for video_id in order:
+            if self.total_bytes <= self.max_bytes:
+                break
+            if video_id == keep:
+                continue
+            janitor.delete(os.path.join(self.cache_dir, self.entries[video_id]['file']))
+            logger.info(f"Evicted {self.entries[video_id]['title']} from the audio cache.")
+            self._drop(video_id)
+
+    # Forgets an entry without touching its file.
+    def _drop(self, video_id):
+        entry = self.entries.pop(video_id, None)
+        if entry:
+            self.total_bytes -= entry['size']
+
+    # Writes the index if it has changes that are still waiting for their timed save.
+    def flush(self):
+        with self.lock:
+            if self.save_timer is not None:
+                self.save_timer.cancel()
+                self.save_timer = None
+            if self.dirty:
+                self._save()
+
+    # Marks the index as changed and has it written within CACHE_INDEX_SAVE_DELAY, so a cache hit on
+    # the way to playback never waits for the whole index to be written. Must be called with the lock held.
+    def _save_later(self):
+        self.dirty = True
+        if self.save_timer is None:
+            self.save_timer = threading.Timer(CACHE_INDEX_SAVE_DELAY, self.flush)
+            self.save_timer.daemon = True
+            self.save_timer.start()
+
+    # Writes the index atomically so a crash never leaves a half-written file behind.
+    def _save(self):
+        self.dirty = False
+        tmp_file = f"{self.index_file}.tmp"
+        try:
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(self.entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            logger.warning(f"Failed to write cache index {self.index_file}: {e}")
+
+audio_cache = AudioCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_EVICTION_POLICY)
+
+# Loudness
+loudness_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")
+
+# Measures a file's integrated loudness (LUFS) and true peak (dBTP) with FFmpeg's EBU R128 filter.
+# Returns a dict with either value None if it could not be measured, e.g. for silence. Blocking.
+def measure_loudness(path):
+    args = ['ffmpeg', '-hide_banner', '-nostats', '-i', path, '-vn', '-af', 'ebur128=peak=true:framelog=quiet', '-f', 'null', '-']
+    creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+    try:
+        process = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, creationflags=creationflags)
+    except OSError as e:
+        logger.error(f"Failed to measure loudness of {path}: {e}")
+        return None
+    process_supervisor.register(process, label=f"loudness {os.path.basename(path)}")
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        logger.warning(f"Failed to measure loudness of {path}: FFmpeg exited with {process.returncode}")
+        return None
+    output = stderr.decode(errors='replace')
+    integrated = re.findall(r"I:\s+(-?[\d.]+|-inf) LUFS", output)
+    peak = re.findall(r"Peak:\s+(-?[\d.]+|-inf) dBFS", output)
+    loudness = {
+        'integrated': float(integrated[-1]) if integrated and integrated[-1] != "-inf" else None,
+        'true_peak': float(peak[-1]) if peak and peak[-1] != "-inf" else None,
+    }
+    if loudness['integrated'] is not None and loudness['integrated'] <= -70:
+        loudness['integrated'] = None
+    return loudness
+
+# Measures a cached track and stores the result with its cache entry.
+def analyze_loudness(video_id):
+    path = audio_cache.path(video_id)
+    if not path:
+        return
+    with metrics.timer('loudness_seconds'):
+        loudness = measure_loudness(path)
+    if loudness is None:
+        return
+    audio_cache.set_loudness(video_id, loudness)
+    logger.info(f"Measured loudness of {audio_cache.title(video_id)}: {loudness['integrated']} LUFS, "
+                f"{audio_cache.gain(video_id):.2f}x gain")
+
+# Queues a cached track for loudness measurement in the background.
+def schedule_loudness_analysis(video_id):
+    if LOUDNESS_NORMALIZATION:
+        loudness_executor.submit(analyze_loudness, video_id)
+
+# Music Library
+# Splits text into search words: case, accents and punctuation do not matter.
+def library_words(text):
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"\w+", text)
+
+class LibrarySong:
+    __slots__ = ('path', 'mtime', 'size', 'title', 'artist', 'album', 'duration', 'title_words')
+
+    # Initializes an indexed audio file with its modification time (ns), size and tags.
+    def __init__(self, path, mtime, size, title, artist=None, album=None, duration=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.title = title
+        self.artist = artist
+        self.album = album
+        self.duration = duration
+        self.title_words = tuple(library_words(title))
+
+    # Returns the song as "Artist - Title", or just the title if the artist is unknown.
+    def display_name(self):
+        return f"{self.artist} - {self.title}" if self.artist else self.title
+
+    # Returns every search word of the song: title, artist and album.
+    def words(self):
+        return set(self.title_words).union(library_words(self.artist or ""), library_words(self.album or ""))
+
+    # Returns the song as a row of the saved index.
+    def to_row(self):
+        return [self.path, self.mtime, self.size, self.title, self.artist, self.album, self.duration]
+
+    # Returns a queue item that plays the file.
+    def track(self, requester=None):
+        return Track(self.path, self.display_name(), duration=self.duration, requester=requester)
+
+class MusicLibrary:
+    # Initializes the index of the audio files under dirs, saved to index_path between runs.
+    # Lookups use a sorted word list for prefix matches and a map from each word to the songs that
+    # have it, both rebuilt off the event loop whenever a scan finds changes.
+    def __init__(self, dirs, index_path):
+        self.dirs = list(dirs)
+        self.index_path = index_path
+        self.songs = {}
+        self.words = []
+        self.postings = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="library")
+        self.tags_available = True
+
+    # Returns the number of indexed songs.
+    def __len__(self):
+        return len(self.songs)
+
+    # Loads the saved index so lookups work before the first scan has finished.
+    def load(self):
+        if not self.index_path:
+            return
+        try:
+            with open(self.index_path, "r", encoding='utf-8') as f:
+                rows = json.load(f).get('songs', [])
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, AttributeError) as e:
+            logger.warning(f"Failed to read music library index {self.index_path}: {e}")
+            return
+        songs = {}
+        for row in rows:
+            try:
+                songs[row[0]] = LibrarySong(*row)
+            except (TypeError, ValueError):
+                continue
+        self._install(songs)
+        logger.info(f"Music library loaded: {len(songs)} song(s)")
+
+    # Rescans LIBRARY_DIRS in the background. Returns a future with the number of songs.
+    def scan(self):
+        return self.executor.submit(self._scan)
+
+    # Stops scanning.
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # Returns the song a request most likely means, or None if no song matches it well enough.
+    # Every word of the request must match a whole word of the song, exactly or with a small typo;
+    # only the last may be the start of a word, and that does not count. The whole-word matches must
+    # cover LIBRARY_MIN_SCORE of the song's title, and no different song may match just as well,
+    # so an ambiguous request is searched on YouTube instead.
+    def find(self, query):
+        words = [word for word in library_words(query) if word not in RESOLUTION_NOISE_WORDS]
+        ranked = self._search(words, fuzzy=True, limit=2)
+        if not ranked or ranked[0][0][0] < LIBRARY_MIN_SCORE:
+            return None
+        (best, song), runner_up = ranked[0], ranked[1:]
+        if runner_up and runner_up[0][0] == best and runner_up[0][1].display_name().casefold() != song.display_name().casefold():
+            return None
+        return song
+
+    # Returns up to limit songs whose words start with the words typed so far, best matches first.
+    def suggest(self, text, limit=AUTOCOMPLETE_LIMIT):
+        return [song for rank, song in self._search(library_words(text), fuzzy=False, limit=limit)]
+
+    # Returns (rank, song) for the best limit songs matching every word, best first. The rank starts
+    # with the score, the share of the song's title words matched; ties go to more exact matches,
+    # then shorter titles. With fuzzy set the words are matched as for find, else as for suggest,
+    # where ties finally go by path so suggestions keep their order.
+    def _search(self, words, fuzzy, limit):
+        if not words:
+            return []
+        with self.lock:
+            vocabulary, postings = self.words, self.postings
+        candidates = None
+        expansions = []
+        for index, word in enumerate(words):
+            counted, matched = self._expand(word, vocabulary, fuzzy, partial=index == len(words) - 1)
+            if not matched:
+                return []
+            expansions.append(counted)
+            found = set().union(*(postings[match] for match in matched))
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return []
+
+        # Ranks a song by how much of its title the request covers.
+        def rank(song):
+            title_words = song.title_words or (song.title.casefold(),)
+            covered = sum(1 for title_word in title_words if any(title_word in counted for counted in expansions))
+            exact = sum(1 for word in words if word in title_words)
+            return covered / len(title_words), exact, -len(title_words)
+
+        key = rank if fuzzy else lambda song: rank(song) + (song.path,)
+        return [(rank(song), song) for song in heapq.nlargest(limit, candidates, key=key)]
+
+    # Returns the known words a search word stands for, as the ones that count toward a song's score
+    # and all it matches. Without fuzzy those are the same: the words it starts. With fuzzy only the
+    # word itself, or close spellings if it is not known, count; if partial is also set, as for the
+    # last word typed, the words it starts match too.
+    @staticmethod
+    def _expand(word, vocabulary, fuzzy, partial=False):
+        start = bisect.bisect_left(vocabulary, word)
+        end = bisect.bisect_left(vocabulary, word + "\U0010ffff", start)
+        prefixed = set(vocabulary[start:end])
+        if not fuzzy:
+            return prefixed, prefixed
+        whole = prefixed & {word}
+        if not whole and len(word) >= 4:
+            whole = set(difflib.get_close_matches(word, vocabulary, n=3, cutoff=LIBRARY_FUZZY_CUTOFF))
+        return whole, (whole | prefixed) if partial else whole
+
+    # Walks the library folders, reading tags only of files that are new or whose size or
+    # modification time changed, and rebuilds the index if anything did. Runs on the scan thread.
+    def _scan(self):
+        started = time.monotonic()
+        with self.lock:
+            old = self.songs
+        songs = {}
+        read = 0
+        for folder in self.dirs:
+            for path, stat in self._walk(folder):
+                song = old.get(path)
+                if song is None or song.mtime != stat.st_mtime_ns or song.size != stat.st_size:
+                    song = self._read(path, stat)
+                    read += 1
+                songs[path] = song
+        removed = len(old.keys() - songs.keys())
+        if read or removed:
+            self._install(songs)
+            self._save(songs)
+        logger.info(f"Music library scanned: {len(songs)} song(s), {read} new or changed, {removed} removed, "
+                    f"in {time.monotonic() - started:.1f}s")
+        return len(songs)
+
+    # Yields the path and stat of every audio file under a folder. Symlinked folders are not followed.
+    def _walk(self, folder):
+        pending = [folder]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                pending.append(entry.path)
+                            elif entry.name.lower().endswith(LIBRARY_EXTENSIONS):
+                                yield entry.path, entry.stat()
+                        except OSError:
+                            continue
+            except OSError as e:
+                logger.warning(f"Cannot read music folder: {e}")
+
+    # Reads a file's tags and length. Without mutagen, or for untagged files, the title comes from
+    # the file name, split into artist and title at " - " if it has one.
+    def _read(self, path, stat):
+        title = artist = album = duration = None
+        if self.tags_available:
+            try:
+                audio = mutagen.File(path, easy=True)
+                if audio is not None:
+                    tags = audio.tags or {}
+                    title, artist, album = (next(iter(tags.get(key) or []), None) for key in ('title', 'artist', 'album'))
+                    duration = round(audio.info.length, 1) if getattr(audio, 'info', None) else None
+            except ImportError:
+                self.tags_available = False
+                logger.info("mutagen is not installed, music library titles come from file names.")
+            except Exception as e:
+                logger.debug(f"Cannot read tags of {path}: {e}")
+        if not title:
+            name = os.path.splitext(os.path.basename(path))[0]
+            name_artist, separator, name_title = name.partition(" - ")
+            title, artist = (name_title, artist or name_artist) if separator else (name, artist)
+        return LibrarySong(path, stat.st_mtime_ns, stat.st_size, title, artist, album, duration)
+
+    # Builds the search structures for a set of songs and swaps them in.
+    def _install(self, songs):
+        postings = {}
+        for song in songs.values():
+            for word in song.words():
+                postings.setdefault(word, set()).add(song)
+        words = sorted(postings)
+        with self.lock:
+            self.songs, self.words, self.postings = songs, words, postings
+
+    # Saves the index.
+    def _save(self, songs):
+        if not self.index_path:
+            return
+        tmp_file = f"{self.index_path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump({'songs': [song.to_row() for song in songs.values()]}, f, separators=(",", ":"))
+            os.replace(tmp_file, self.index_path)
+        except OSError as e:
+            logger.warning(f"Failed to write music library index {self.index_path}: {e}")
+
+music_library = MusicLibrary(LIBRARY_DIRS, LIBRARY_INDEX_FILE)
+
+# Returns a queue item for a request if the music library has the song, so it plays without a
+# YouTube search. Links never match.
+def library_track(query, requester=None):
+    if not len(music_library) or query.strip().startswith(("http://", "https://")):
+        return None
+    song = music_library.find(query)
+    return song.track(requester) if song else None
+
+# Resolution Cache
+class ResolutionCache:
+    # Initializes a TTL-bounded map from normalized search queries to resolved videos, optionally persisted to a file.
+    def __init__(self, ttl, max_entries, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Normalizes a query so that case, punctuation and trailing filler words like "official video" or
+    # "lyrics" do not matter. Filler words inside a query are kept, as is everything in a query of
+    # RESOLUTION_MIN_KEY_WORDS words or fewer, and nothing is stripped if that would remove most of
+    # the query, so different songs never end up sharing a key.
+    @staticmethod
+    def normalize(query):
+        query = unicodedata.normalize("NFKC", query).strip()
+        if query.startswith(("http://", "https://")):
+            return query
+        words = re.findall(r"\w+", query.casefold())
+        kept = len(words)
+        while kept > RESOLUTION_MIN_KEY_WORDS and words[kept - 1] in RESOLUTION_NOISE_WORDS:
+            kept -= 1
+        if kept * 2 < len(words):
+            kept = len(words)
+        return " ".join(words[:kept]) or query.casefold()
+
+    # Loads persisted resolutions, skipping any that have already expired.
+    def load(self):
+        if not self.path:
+            return
+        with self.lock:
+            try:
+                with open(self.path, "r", encoding='utf-8') as f:
+                    entries = json.load(f)
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError) as e:
+                logger.warning(f"Failed to read resolution cache {self.path}: {e}")
+                return
+            now = time.time()
+            self.entries = OrderedDict((key, video) for key, video in entries.items() if video.get('expires', 0) > now)
+            logger.info(f"Resolution cache loaded: {len(self.entries)} entries")
+
+    # Returns the cached video for a query, or None on a miss or expired entry.
+    def get(self, query):
+        key = self.normalize(query)
+        with self.lock:
+            video = self.entries.get(key)
+            if video and video['expires'] > time.time():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc('cache_lookups_total', {'layer': "resolution", 'result': "hit"})
+                return dict(video)
+            if video:
+                del self.entries[key]
+            self.misses += 1
+            metrics.inc('cache_lookups_total', {'layer': "resolution", 'result': "miss"})
+            return None
+
+    # Stores the video a query resolved to, dropping the oldest entries beyond the size bound.
+    def put(self, query, video):
+        key = self.normalize(query)
+        entry = {
+            'id': video['id'],
+            'title': video['title'],
+            'duration': video.get('duration'),
+            'url': video.get('url'),
+            'acodec': video.get('acodec'),
+            'expires': time.time() + self.ttl,
+        }
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self._save()
+
+    # Returns the unexpired queries and the videos they resolved to, most recently used first.
+    # Does not count as lookups.
+    def known(self):
+        now = time.time()
+        with self.lock:
+            return [(key, dict(video)) for key, video in reversed(self.entries.items()) if video['expires'] > now]
+
+    # Returns hit/miss counters and the current size.
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self.entries),
+            }
+
+    # Writes the entries atomically if persistence is enabled. Must be called with the lock held.
+    def _save(self):
+        if not self.path:
+            return
+        tmp_file = f"{self.path}.tmp"
+        try:
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to write resolution cache {self.path}: {e}")
+
+resolution_cache = ResolutionCache(RESOLUTION_CACHE_TTL, RESOLUTION_CACHE_MAX_ENTRIES, RESOLUTION_CACHE_FILE)
+
+# Download Scheduler
+class DownloadJob:
+    # Initializes a single download shared by every track that wants the same video.
+    def __init__(self, video_id, query, title, priority, future):
+        self.video_id = video_id
+        self.query = query
+        self.title = title
+        self.priority = priority
+        self.future = future
+        self.owners = set()
+        self.cancel_event = threading.Event()
+        self.started = False
+
+class DownloadScheduler:
+    # Initializes a bounded pool of download workers that serves jobs by priority class.
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download")
+        self.jobs = {}
+        self.pending = None
+        self.sequence = itertools.count()
+
+    # Starts the worker tasks on the running loop the first time a job is submitted.
+    def _ensure_workers(self):
+        if self.pending is None:
+            self.pending = asyncio.PriorityQueue()
+            for _ in range(self.workers):
+                asyncio.create_task(self._worker())
+
+    # Queues a job entry; stale entries left behind by a priority change are skipped by the workers.
+    def _push(self, job):
+        self.pending.put_nowait((job.priority, next(self.sequence), job))
+
+    # Requests a video for owner, joining the download already in flight for it if there is one.
+    # A cancelled download that is still running is taken back rather than started a second time,
+    # so two yt-dlp runs never write the same files. Returns a future that resolves to
+    # (file_path, message) like download_song.
+    def submit(self, video_id, query, title, owner, priority=PRIORITY_PREFETCH):
+        self._ensure_workers()
+        job = self.jobs.get(video_id)
+        if job is None:
+            job = DownloadJob(video_id, query, title, priority, asyncio.get_running_loop().create_future())
+            self.jobs[video_id] = job
+            self._push(job)
+        elif job.cancel_event.is_set():
+            job.cancel_event.clear()
+            logger.info(f"Resumed cancelled download of {job.title}")
+        else:
+            self.reprioritize(video_id, priority)
+        job.owners.add(owner)
+        return job.future
+
+    # Moves a queued job into a more urgent priority class.
+    def reprioritize(self, video_id, priority):
+        job = self.jobs.get(video_id)
+        if job and not job.started and priority < job.priority:
+            job.priority = priority
+            self._push(job)
+
+    # Drops owner's interest in a video, cancelling the download once nobody wants it any more.
+    # A running download stays registered until yt-dlp has stopped, so a new request can take it back.
+    def release(self, owner, video_id):
+        job = self.jobs.get(video_id)
+        if not job or owner not in job.owners:
+            return
+        job.owners.discard(owner)
+        if job.owners:
+            return
+        job.cancel_event.set()
+        if not job.started:
+            del self.jobs[video_id]
+            if not job.future.done():
+                job.future.set_result((None, "Cancelled."))
+        logger.info(f"Cancelled download of {job.title}")
+
+    # Runs queued jobs on the download pool, most urgent first.
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            priority, _, job = await self.pending.get()
+            if job.started or job.cancel_event.is_set() or priority != job.priority:
+                continue
+            job.started = True
+            while True:
+                try:
+                    result = await loop.run_in_executor(self.executor, download_song, job.query, {'id': job.video_id, 'title': job.title}, job.cancel_event)
+                except Exception as e:
+                    result = (None, f"Error downloading: {e}")
+                # Taken back by a new request after yt-dlp had already given up: download it again
+                if result[0] is None and job.owners and not job.cancel_event.is_set() and result[1] == "Cancelled.":
+                    continue
+                break
+            if self.jobs.get(job.video_id) is job:
+                del self.jobs[job.video_id]
+            if not job.future.done():
+                job.future.set_result(result)
+
+download_scheduler = DownloadScheduler(DOWNLOAD_WORKERS)
+
+# Soundboard
+class PCMBufferAudio(discord.AudioSource):
+    # Initializes an audio source that plays 48kHz stereo PCM straight from memory.
+    def __init__(self, pcm):
+        self.pcm = memoryview(pcm)
+        self.offset = 0
+
+    # Returns the next 20ms frame, padding the last one with silence.
+    def read(self):
+        frame = self.pcm[self.offset:self.offset + FRAME_SIZE]
+        self.offset += FRAME_SIZE
+        if not frame:
+            return b''
+        if len(frame) < FRAME_SIZE:
+            return bytes(frame) + bytes(FRAME_SIZE - len(frame))
+        return bytes(frame)
+
+class Soundboard:
+    # Initializes the registry of quick sounds, decoded once and kept in memory up to max_bytes.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.assignments = {}
+        self.buffers = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    # Loads the button assignments from the quick play file.
+    def load(self):
+        with self.lock:
+            self.assignments = load_quick_play_files()
+
+    # Returns the file assigned to a quick sound, or None.
+    def path(self, name):
+        return self.assignments.get(name)
+
+    # Assigns a file to a quick sound, saving it and dropping any stale decoded copy.
+    def assign(self, name, file_path):
+        save_quick_play_file(name, file_path)
+        with self.lock:
+            self.assignments[name] = file_path
+            self._discard(name)
+
+    # Returns the decoded PCM for a quick sound if it is in memory and its file has not changed.
+    # Files are only checked again every SOUNDBOARD_CHECK_INTERVAL seconds.
+    def cached(self, name):
+        with self.lock:
+            entry = self.buffers.get(name)
+            path = self.assignments.get(name)
+            if not entry or entry['path'] != path:
+                return None
+            now = time.time()
+            if now - entry['checked'] >= SOUNDBOARD_CHECK_INTERVAL:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    self._discard(name)
+                    return None
+                if (stat.st_mtime, stat.st_size) != entry['stamp']:
+                    logger.info(f"Quick sound {path} changed on disk, reloading.")
+                    self._discard(name)
+                    return None
+                entry['checked'] = now
+            self.buffers.move_to_end(name)
+        metrics.inc('cache_lookups_total', {'layer': "soundboard", 'result': "hit"})
+        return entry['pcm']
+
+    # Returns the decoded PCM for a quick sound, decoding it with FFmpeg if needed. Blocking.
+    def get(self, name):
+        pcm = self.cached(name)
+        if pcm is not None:
+            return pcm
+        path = self.assignments.get(name)
+        if not path or not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        metrics.inc('cache_lookups_total', {'layer': "soundboard", 'result': "miss"})
+        pcm = self._decode(path)
+        if pcm is None:
+            return None
+        with self.lock:
+            self._discard(name)
+            if len(pcm) > self.max_bytes:
+                logger.warning(f"Quick sound {path} is larger than the soundboard memory cap, not keeping it.")
+                return pcm
+            while self.buffers and self.total_bytes + len(pcm) > self.max_bytes:
+                self._discard(next(iter(self.buffers)))
+            self.buffers[name] = {'path': path, 'stamp': (stat.st_mtime, stat.st_size), 'checked': time.time(), 'pcm': pcm}
+            self.total_bytes += len(pcm)
+        return pcm
+
+    # Decodes every assigned quick sound ahead of the first press. Blocking.
+    def preload(self):
+        for name in list(self.assignments):
+            self.get(name)
+        logger.info(f"Soundboard ready: {len(self.buffers)} sound(s), {self.total_bytes / 1048576:.1f} MiB")
+
+    # Forgets the decoded copy of a quick sound. Must be called with the lock held.
+    def _discard(self, name):
+        entry = self.buffers.pop(name, None)
+        if entry:
+            self.total_bytes -= len(entry['pcm'])
+
+    # Decodes a file to 48kHz stereo 16-bit PCM with a single FFmpeg run.
+    @staticmethod
+    def _decode(path):
+        args = ['ffmpeg', '-loglevel', 'error', '-i', path, '-f', 's16le', '-ar', '48000', '-ac', '2', 'pipe:1']
+        creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        try:
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, creationflags=creationflags)
+        except OSError as e:
+            logger.error(f"Failed to decode quick sound {path}: {e}")
+            return None
+        process_supervisor.register(process, label=f"decode {os.path.basename(path)}")
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            logger.error(f"Failed to decode quick sound {path}: {stderr.decode(errors='replace').strip()}")
+            return None
+        return stdout
+
+soundboard = Soundboard(SOUNDBOARD_MAX_BYTES)
+
+# Mixer
+class PrimedSource(discord.AudioSource):
+    # Wraps a source and reads its first frames up front, so FFmpeg has already started
+    # by the time the mixer switches to it. Blocks until those frames are read.
+    def __init__(self, source, frames=GAPLESS_PRIME_FRAMES):
+        self.source = source
+        self.buffer = deque()
+        for _ in range(frames):
+            data = source.read()
+            if not data:
+                break
+            self.buffer.append(data)
+
+    # Returns the buffered frames first, then reads on from the wrapped source.
+    def read(self):
+        if self.buffer:
+            return self.buffer.popleft()
+        return self.source.read()
+
+    # Drops the next frames, e.g. those the old source played while this one was being opened.
+    def skip(self, frames):
+        for _ in range(max(0, frames)):
+            if not self.read():
+                break
+
+    # Returns True if the wrapped source produces Opus packets.
+    def is_opus(self):
+        return self.source.is_opus()
+
+    # Releases the wrapped source.
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+class MixerSource(discord.AudioSource):
+    # Initializes a source that sums a music layer and any number of quick sound layers frame by frame.
+    # The next track can be staged with set_next; the mixer switches to it the moment the current
+    # one runs out, or fades between them over CROSSFADE_SECONDS when the track length is known.
+    def __init__(self, on_music_end=None, on_overlays_done=None, on_preload_due=None):
+        self.music = None
+        self.music_is_opus = False
+        self.music_frames = 0
+        self.music_duration = None
+        self.music_gain = 1.0
+        self.music_requested_at = None
+        self.music_paused = False
+        self.next_music = None
+        self.next_track = None
+        self.next_is_opus = False
+        self.next_duration = None
+        self.next_gain = 1.0
+        self.next_requested_at = None
+        self.fade_frames = 0
+        self.preload_requested = False
+        self.decoders = {}
+        self.last_frame_opus = False
+        self.volume = music_volume
+        self.overlay_volume = quick_sound_volume
+        self.overlays = []
+        self.retired = []
+        self.ended = False
+        self.cut_off = False  # Set if the stream ended early with music still loaded, see WorkerMixerSource.
+        self.on_music_end = on_music_end
+        self.on_overlays_done = on_overlays_done
+        self.on_preload_due = on_preload_due
+        self.lock = threading.Lock()
+
+    # Replaces the music layer. Returns False if the mixer has already finished and must be replaced.
+    # The old layer is cleaned up on the audio thread so it is never closed mid-read.
+    # Pass start_frames to keep counting the position when reopening the same track at an offset,
+    # and the duration in seconds, if known, to time the preload of the next track. gain is the track's
+    # loudness correction, applied here on top of the music volume (which Opus has baked in by FFmpeg);
+    # Opus music that needs one is decoded for it rather than passed through.
+    # requested_at is the time.monotonic() of the request to report the time to first audio for.
+    def set_music(self, source, start_frames=0, duration=None, gain=1.0, requested_at=None):
+        with self.lock:
+            if self.ended:
+                return False
+            if self.music:
+                self.retired.append(self.music)
+            self.music, self.music_frames, self.music_duration = source, start_frames, duration
+            self.music_gain, self.music_requested_at = gain, requested_at
+            self.music_is_opus = source is not None and source.is_opus()
+            self.preload_requested = False
+        return True
+
+    # Stages the source to play after the current music. Returns False if there is no music to follow.
+    def set_next(self, source, track, duration=None, gain=1.0, requested_at=None):
+        with self.lock:
+            if self.ended or self.music is None:
+                return False
+            if self.next_music:
+                self.retired.append(self.next_music)
+            self.next_music, self.next_track, self.next_duration = source, track, duration
+            self.next_gain, self.next_requested_at = gain, requested_at
+            self.next_is_opus = source.is_opus()
+            self.fade_frames = 0
+        return True
+
+    # Takes back the staged source if it belongs to the given track, or None if it does not.
+    def take_next(self, track):
+        with self.lock:
+            if self.next_music is None or self.next_track is not track:
+                return None
+            source = self.next_music
+            self.next_music, self.next_track = None, None
+        return source
+
+    # Drops the staged source and asks for a new one to be prepared, e.g. after the queue changed.
+    def clear_next(self):
+        with self.lock:
+            if self.next_music:
+                self.retired.append(self.next_music)
+            self.next_music, self.next_track = None, None
+            self.preload_requested = False
+
+    # Returns True while a music layer is loaded, or staged to follow one that just ended.
+    def has_music(self):
+        return self.music is not None or self.next_music is not None
+
+    # Returns the music position in seconds, counted from the frames actually read.
+    def position(self):
+        return self.music_frames * FRAME_SIZE / BYTES_PER_SECOND
+
+    # Returns the frame at which the current music should start fading into the next one, or None.
+    def _fade_start(self):
+        if not CROSSFADE_SECONDS or not self.music_duration:
+            return None
+        return max(0, int((self.music_duration - CROSSFADE_SECONDS) * BYTES_PER_SECOND / FRAME_SIZE))
+
+    # Returns True once the current music is close enough to its end to open the next track.
+    # Tracks of unknown length preload straight away.
+    def _preload_due(self):
+        if not self.music_duration:
+            return True
+        lead = GAPLESS_PRELOAD_SECONDS + CROSSFADE_SECONDS
+        return self.music_frames * FRAME_SIZE / BYTES_PER_SECOND >= self.music_duration - lead
+
+    # Makes the staged source the music layer and returns its track. Must be called with the lock held.
+    def _promote(self):
+        if self.music:
+            self.retired.append(self.music)
+        track = self.next_track
+        self.music, self.music_is_opus, self.music_duration = self.next_music, self.next_is_opus, self.next_duration
+        self.music_gain, self.music_requested_at = self.next_gain, self.next_requested_at
+        self.music_frames, self.fade_frames = self.fade_frames, 0
+        self.next_music, self.next_track = None, None
+        self.preload_requested = False
+        return track
+
+    # Layers a quick sound over the music. Returns False if the mixer has already finished.
+    def add_overlay(self, source):
+        with self.lock:
+            if self.ended:
+                return False
+            self.overlays.append(source)
+        return True
+
+    # Returns True if the frame last returned by read is an Opus packet rather than PCM.
+    def is_opus(self):
+        return self.last_frame_opus
+
+    # Returns the next mixed 20ms frame, or b'' once there is nothing left to play.
+    # Opus music is passed through as-is unless quick sounds, a crossfade or its loudness correction
+    # need it decoded.
+    def read(self):
+        return self._read_frame()
+
+    # Builds the next frame from the music and quick sound layers.
+    def _read_frame(self):
+        promoted = None
+        with self.lock:
+            retired, self.retired = self.retired, []
+            if self.music is None and self.next_music is not None:
+                promoted = self._promote()
+            music, music_is_opus = self.music, self.music_is_opus
+            next_music = self.next_music
+            overlays = list(self.overlays)
+        for source in retired:
+            self._forget(source)
+            source.cleanup()
+        if promoted is not None and self.on_music_end:
+            self.on_music_end(promoted)
+
+        if music is not None and not self.preload_requested and next_music is None and self._preload_due():
+            self.preload_requested = True
+            if self.on_preload_due:
+                self.on_preload_due()
+
+        frame = None
+        music_ended = False
+        if music is not None and not self.music_paused:
+            fade_start = self._fade_start()
+            fading = next_music is not None and fade_start is not None and self.music_frames >= fade_start
+            data = self._read_music(music, music_is_opus)
+            if data and self.music_requested_at is not None:
+                metrics.observe('time_to_first_audio_seconds', time.monotonic() - self.music_requested_at)
+                self.music_requested_at = None
+            if data and music_is_opus and self.music_gain == 1.0 and not overlays and not fading:
+                self.music_frames += 1
+                self.last_frame_opus = True
+                return data
+            if data:
+                self.music_frames += 1
+                frame = self._pcm(music, data, music_is_opus, self.music_gain if music_is_opus else self.volume * self.music_gain)
+                if fading:
+                    frame = self._crossfade(frame, next_music)
+            else:
+                music_ended = True
+        self.last_frame_opus = False
+
+        following = None
+        with self.lock:
+            if music_ended and self.music is music:
+                self.retired.append(music)
+                self.music = None
+                if self.next_music is not None:
+                    following = self._promote()
+            else:
+                music_ended = False
+            overlays = list(self.overlays)
+        if music_ended:
+            if self.on_music_end:
+                self.on_music_end(following)
+            if following is not None:
+                # Carry straight on into the next track so there is no silent frame between them.
+                return self._read_frame()
+
+        for overlay in overlays:
+            data = overlay.read()
+            if not data:
+                with self.lock:
+                    self.overlays.remove(overlay)
+                overlay.cleanup()
+                if not self.overlays and self.on_overlays_done:
+                    self.on_overlays_done()
+                continue
+            data = self._pcm(overlay, data, False, self.overlay_volume)
+            frame = data if frame is None else self._add(frame, data)
+
+        if frame is not None:
+            return frame
+        with self.lock:
+            if self.music is None and self.next_music is None and not self.overlays:
+                self.ended = True
+                return b''
+        return bytes(FRAME_SIZE)
+
+    # Reads a music layer's next frame, skipping the header packets an Opus source starts with so
+    # they neither take up a frame of silence when decoded nor reach Discord when passed through.
+    @staticmethod
+    def _read_music(source, is_opus):
+        data = source.read()
+        while is_opus and data[:8] in OPUS_HEADER_PACKETS:
+            data = source.read()
+        return data
+
+    # Mixes the start of the staged track into a frame of the current one, ramping the two
+    # volumes across CROSSFADE_SECONDS, and makes it the music layer once the fade completes.
+    def _crossfade(self, frame, next_music):
+        data = self._read_music(next_music, self.next_is_opus)
+        self.fade_frames += 1
+        fade_length = max(1, int(CROSSFADE_SECONDS * BYTES_PER_SECOND / FRAME_SIZE))
+        progress = min(1.0, self.fade_frames / fade_length)
+        if data:
+            gain = progress * self.next_gain if self.next_is_opus else progress * self.volume * self.next_gain
+            incoming = self._pcm(next_music, data, self.next_is_opus, gain)
+            frame = self._add(self._fade(frame, 1.0 - progress), incoming)
+        if progress >= 1.0 or not data:
+            with self.lock:
+                promoted = self._promote() if self.next_music is next_music else None
+            if promoted is not None and self.on_music_end:
+                self.on_music_end(promoted)
+        return frame
+
+    # Returns a music frame as PCM at the given volume, decoding it first if it is an Opus packet.
+    # Packets that are not audio, like the Ogg headers FFmpegOpusAudio starts with, come out as silence.
+    def _pcm(self, source, data, is_opus, volume):
+        if is_opus:
+            decoder = self.decoders.get(source)
+            if decoder is None:
+                decoder = self.decoders[source] = discord.opus.Decoder()
+            try:
+                data = decoder.decode(data)[:FRAME_SIZE]
+            except discord.opus.OpusError:
+                data = bytes(FRAME_SIZE)
+        return self._scale(data, volume)
+
+    # Pads a frame to full length and applies a layer volume.
+    @staticmethod
+    def _scale(data, volume):
+        if len(data) < FRAME_SIZE:
+            data += bytes(FRAME_SIZE - len(data))
+        return data if volume == 1.0 else audioop.mul(data, 2, min(volume, MAX_LAYER_GAIN))
+
+    # Sums two mixed frames.
+    @staticmethod
+    def _add(frame, data):
+        return audioop.add(frame, data, 2)
+
+    # Scales a mixed frame, e.g. to fade it out.
+    @staticmethod
+    def _fade(frame, gain):
+        return audioop.mul(frame, 2, gain)
+
+    # Drops the decoder of a source that has been retired.
+    def _forget(self, source):
+        self.decoders.pop(source, None)
+
+    # Releases the music layers and any quick sounds still playing.
+    def cleanup(self):
+        with self.lock:
+            self.ended = True
+            sources = [self.music, self.next_music] + self.overlays + self.retired
+            self.music, self.next_music, self.next_track, self.overlays, self.retired = None, None, None, [], []
+        for source in sources:
+            if source:
+                source.cleanup()
+
+class WorkerMixerSource(MixerSource):
+    # Initializes a mixer that leaves decoding, mixing and Opus encoding to an audio worker process.
+    # Frames are described as lists of (key, data, is_opus, volume) layers instead of being mixed here,
+    # so the bot process only reads the sources and forwards packets.
+    def __init__(self, worker, on_music_end=None, on_overlays_done=None, on_preload_due=None):
+        super().__init__(on_music_end, on_overlays_done, on_preload_due)
+        self.worker = worker
+        self.stream_id = worker.open()
+
+    # Returns one layer for the worker to decode if needed and scale.
+    def _pcm(self, source, data, is_opus, volume):
+        return [(id(source), data, is_opus, min(volume, MAX_LAYER_GAIN))]
+
+    # Combines the layers of two partial frames.
+    @staticmethod
+    def _add(frame, data):
+        return frame + data
+
+    # Scales every layer of a partial frame.
+    @staticmethod
+    def _fade(frame, gain):
+        return [(key, data, is_opus, volume * gain) for key, data, is_opus, volume in frame]
+
+    # Tells the worker to drop the decoder of a retired source.
+    def _forget(self, source):
+        self.worker.forget(self.stream_id, id(source))
+
+    # Always returns Opus: passed-through packets, or the worker's encoding of the mixed layers.
+    def is_opus(self):
+        return True
+
+    # Returns the next frame as an Opus packet, or b'' once there is nothing left to play or the worker
+    # failed. A failure with music loaded sets cut_off so the player can pick the song up again.
+    def read(self):
+        frame = self._read_frame()
+        if not frame or self.last_frame_opus:
+            return frame
+        if isinstance(frame, bytes):
+            return OPUS_SILENCE
+        packet = self.worker.encode(self.stream_id, frame)
+        if not packet:
+            self.cut_off = self.has_music()
+        return packet
+
+    # Releases the layers and the worker's state for this stream.
+    def cleanup(self):
+        super().cleanup()
+        self.worker.close(self.stream_id)
+
+# Audio Workers
+class AudioWorker:
+    # Starts a worker process connected to the bot by a pipe.
+    def __init__(self, context, index):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=audio_worker.run, args=(child_conn,), name=f"audio-worker-{index}", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+        self.streams = set()
+        self.next_stream_id = itertools.count(1)
+        self.started = False
+        self.failed = False
+
+    # Returns True while the process can take frames.
+    def alive(self):
+        return not self.failed and self.process.is_alive()
+
+    # Registers a new voice stream with the worker and returns its ID.
+    def open(self):
+        with self.lock:
+            stream_id = next(self.next_stream_id)
+            self.streams.add(stream_id)
+        return stream_id
+
+    # Has the worker encode one frame's layers and returns the Opus packet, or b'' if the worker
+    # has failed, which ends the stream so the player can start over on another worker.
+    def encode(self, stream_id, layers):
+        with self.lock:
+            if self.failed:
+                return b''
+            try:
+                self.conn.send(("frame", stream_id, layers))
+                if not self.conn.poll(AUDIO_WORKER_TIMEOUT if self.started else AUDIO_WORKER_START_TIMEOUT):
+                    raise TimeoutError("no answer")
+                packet = self.conn.recv_bytes()
+                self.started = True
+            except (OSError, EOFError, TimeoutError) as e:
+                logger.error(f"Audio worker {self.process.name} failed: {e}")
+                self.failed = True
+                self.process.kill()
+                return b''
+        return packet or OPUS_SILENCE
+
+    # Sends a message that needs no answer, ignoring a worker that has already gone.
+    def _send(self, message):
+        with self.lock:
+            if self.failed:
+                return
+            try:
+                self.conn.send(message)
+            except OSError:
+                self.failed = True
+
+    # Lets the worker drop the decoder kept for a retired source.
+    def forget(self, stream_id, key):
+        self._send(("forget", stream_id, key))
+
+    # Ends a voice stream on the worker.
+    def close(self, stream_id):
+        with self.lock:
+            self.streams.discard(stream_id)
+        self._send(("close", stream_id))
+
+    # Stops the process.
+    def stop(self):
+        self.conn.close()
+        self.process.join(REAP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+
+class AudioWorkerPool:
+    # Initializes a pool of up to size worker processes, started as voice streams need them.
+    def __init__(self, size):
+        self.size = size
+        self.workers = []
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+        self.spawned = itertools.count(1)
+
+    # Starts the workers up front so the first song does not wait for one to load.
+    def start(self):
+        with self.lock:
+            while len(self.workers) < self.size:
+                self._spawn()
+
+    # Starts one more worker. Must be called with the lock held.
+    def _spawn(self):
+        worker = AudioWorker(self.context, next(self.spawned))
+        self.workers.append(worker)
+        logger.info(f"Started {worker.process.name} (pid {worker.process.pid}).")
+        return worker
+
+    # Returns the live worker with the fewest voice streams, replacing failed workers and
+    # starting another while the pool has room.
+    def acquire(self):
+        with self.lock:
+            for worker in [w for w in self.workers if not w.alive()]:
+                self.workers.remove(worker)
+                worker.stop()
+            idle = [worker for worker in self.workers if not worker.streams]
+            if idle:
+                return idle[0]
+            if len(self.workers) < self.size:
+                return self._spawn()
+            return min(self.workers, key=lambda worker: len(worker.streams))
+
+    # Stops every worker.
+    def shutdown(self):
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            worker.stop()
+
+audio_workers = AudioWorkerPool(AUDIO_WORKERS)
+
+# Returns a mixer for a guild's voice stream, doing its audio work in a worker process if AUDIO_WORKERS is set.
+def create_mixer(**callbacks):
+    if audio_workers.size > 0:
+        return WorkerMixerSource(audio_workers.acquire(), **callbacks)
+    return MixerSource(**callbacks)
+
+# Queue Track
+track_ids = itertools.count(1)
+
+class Track:
+    __slots__ = ('source', 'title', 'video_id', 'is_stream', 'codec', 'duration', 'requester', 'query', 'mode',
+                 'state', 'error', 'download_future', 'priority', 'requested_at', 'track_id')
+
+    # Initializes a queue item: a local file path, a direct audio URL when is_stream is set,
+    # or an unresolved search query (source None) that is resolved when prefetched or played.
+    def __init__(self, source, title, video_id=None, is_stream=False, query=None, mode=DEFAULT_PLAY_MODE, codec=None,
+                 duration=None, requester=None):
+        self.source = source
+        self.title = title
+        self.video_id = video_id
+        self.is_stream = is_stream
+        self.codec = codec
+        self.duration = duration
+        self.requester = requester
+        self.query = query
+        self.mode = mode
+        self.state = "ready" if source else "pending"
+        self.error = None
+        self.download_future = None
+        self.priority = PRIORITY_PREFETCH
+        self.requested_at = time.monotonic()
+        self.track_id = next(track_ids)
+
+    # Returns True if the track can still be opened by FFmpeg.
+    def is_available(self):
+        return self.source is not None and (self.is_stream or os.path.exists(self.source))
+
+    # Returns True if the track is already Opus and can be sent to Discord without transcoding.
+    def is_opus_native(self):
+        if self.is_stream:
+            return self.codec == "opus"
+        return self.source is not None and self.source.lower().endswith(OPUS_EXTENSIONS)
+
+    # Returns a one-line description with the length, requester and any state other than ready.
+    def summary(self):
+        text = self.title
+        if self.duration:
+            minutes, seconds = divmod(int(self.duration), 60)
+            text += f" [{minutes}:{seconds:02d}]"
+        if self.requester:
+            text += f" - {self.requester}"
+        if self.state != "ready":
+            text += f" ({self.state})"
+        return text
+
+    # Marks the track as playable from the given file path or stream URL.
+    def resolved(self, source, title, video_id=None, is_stream=False, codec=None):
+        self.source, self.title, self.is_stream, self.codec, self.state = source, title, is_stream, codec, "ready"
+        self.video_id = video_id or self.video_id
+
+    # Returns what is needed to queue the track again after a restart. Stream URLs expire, so only
+    # local files are kept; a streamed track is looked up again unless it was cached meanwhile.
+    def to_dict(self):
+        entry = {'title': self.title, 'video_id': self.video_id, 'query': self.query, 'mode': self.mode,
+                 'duration': self.duration, 'requester': self.requester}
+        if self.source and not self.is_stream:
+            entry['file'] = self.source
+        return {key: value for key, value in entry.items() if value is not None}
+
+    # Rebuilds a track saved by to_dict, playable straight away if its file is still on disk.
+    # Returns None if there is nothing left to play it from.
+    @classmethod
+    def from_dict(cls, entry):
+        video_id = entry.get('video_id')
+        path = audio_cache.path(video_id) if video_id else None
+        if not (path and os.path.exists(path)):
+            path = entry['file'] if entry.get('file') and os.path.exists(entry['file']) else None
+        query = entry.get('query') or (video_url(video_id) if video_id else None)
+        if path is None and query is None:
+            return None
+        return cls(path, entry.get('title') or query, video_id, query=query, mode=entry.get('mode', DEFAULT_PLAY_MODE),
+                   duration=entry.get('duration'), requester=entry.get('requester'))
+
+# Playlist
+class PlaylistFull(Exception):
+    pass
+
+class Playlist:
+    # Initializes an ordered list of tracks holding at most capacity entries. After every change
+    # on_change is called with the kind of change ("add", "pop", "remove", "move", "shuffle" or "clear")
+    # and the track concerned, if any. Never blocks: adding to a full playlist raises PlaylistFull.
+    def __init__(self, capacity=MAX_QUEUE_SIZE, on_change=None):
+        self.entries = deque()
+        self.capacity = capacity
+        self.on_change = on_change
+        self.lock = threading.Lock()
+
+    # Returns the number of queued tracks.
+    def __len__(self):
+        return len(self.entries)
+
+    # Returns a snapshot of the queued tracks. Safe to call from any thread.
+    def items(self):
+        with self.lock:
+            return list(self.entries)
+
+    # Returns the track that plays next without removing it, or None if the playlist is empty.
+    def peek(self):
+        with self.lock:
+            return self.entries[0] if self.entries else None
+
+    # Adds a track to the end and returns its 1-based position.
+    def append(self, track):
+        with self.lock:
+            if len(self.entries) >= self.capacity:
+                raise PlaylistFull(f"Playlist is full ({self.capacity} tracks).")
+            self.entries.append(track)
+            position = len(self.entries)
+        self._changed("add", track)
+        return position
+
+    # Adds as many of the tracks as there is room for, with a single change notification.
+    # Returns the 1-based position of the first one and how many were added.
+    def extend(self, tracks):
+        with self.lock:
+            tracks = list(tracks)[:max(0, self.capacity - len(self.entries))]
+            self.entries.extend(tracks)
+            position = len(self.entries) - len(tracks) + 1
+        if tracks:
+            self._changed("add", None)
+        return position, len(tracks)
+
+    # Removes and returns the next track, or None if the playlist is empty. Pass track to only
+    # remove it if it is still the one next in line.
+    def popleft(self, track=None):
+        with self.lock:
+            if not self.entries or (track is not None and self.entries[0] is not track):
+                return None
+            track = self.entries.popleft()
+        self._changed("pop", track)
+        return track
+
+    # Removes and returns the track at a 0-based index. Raises IndexError if there is none.
+    def remove(self, index):
+        with self.lock:
+            if not 0 <= index < len(self.entries):
+                raise IndexError(index)
+            track = self.entries[index]
+            del self.entries[index]
+        self._changed("remove", track)
+        return track
+
+    # Moves the track at a 0-based index to a new index and returns it. Raises IndexError if either is out of range.
+    def move(self, index, new_index):
+        with self.lock:
+            if not 0 <= index < len(self.entries) or not 0 <= new_index < len(self.entries):
+                raise IndexError(index)
+            track = self.entries[index]
+            del self.entries[index]
+            self.entries.insert(new_index, track)
+        self._changed("move", track)
+        return track
+
+    # Puts the queued tracks in random order.
+    def shuffle(self):
+        with self.lock:
+            entries = list(self.entries)
+            random.shuffle(entries)
+            self.entries = deque(entries)
+        self._changed("shuffle", None)
+
+    # Empties the playlist and returns the tracks that were in it.
+    def clear(self):
+        with self.lock:
+            entries = list(self.entries)
+            self.entries.clear()
+        self._changed("clear", None)
+        return entries
+
+    # Tells the listener about a change.
+    def _changed(self, kind, track):
+        if self.on_change:
+            try:
+                self.on_change(kind, track)
+            except Exception as e:
+                logger.warning(f"Playlist listener error: {e}")
+
+# Opens an FFmpeg music source for a track, optionally seeking to a position in seconds.
+# Opus tracks are passed through untouched at unity gain; any other gain, i.e. the music volume, is
+# applied inside FFmpeg, which also does the Opus encode. Other formats decode to PCM and the mixer
+# applies volume. Loudness corrections are always left to the mixer.
+# The FFmpeg process is registered with the supervisor under owner, normally the guild ID.
+def create_music_source(track, position=0, gain=1.0, owner=None):
+    before_options = []
+    if track.is_stream:
+        before_options.append(STREAM_BEFORE_OPTIONS)
+    if position:
+        before_options.append(f"-ss {position}")
+    before_options = " ".join(before_options) or None
+    if OPUS_PASSTHROUGH and track.is_opus_native():
+        if gain == 1.0:
+            source = discord.FFmpegOpusAudio(track.source, codec='copy', before_options=before_options, options="-vn")
+        else:
+            source = discord.FFmpegOpusAudio(track.source, before_options=before_options, options=f"-vn -af volume={gain:.3f}")
+    else:
+        source = discord.FFmpegPCMAudio(track.source, before_options=before_options, options="-vn")
+    return process_supervisor.track(source, owner, track.title)
+
+# Returns the loudness correction for a track. Only cached songs have been measured.
+def track_gain(track):
+    if track.is_stream or not track.video_id:
+        return 1.0
+    return audio_cache.gain(track.video_id)
+
+# Returns the player for a guild, creating it on first use.
+def get_player(guild_id):
+    player = players.get(guild_id)
+    if player is None:
+        player = players[guild_id] = GuildPlayer(guild_id)
+    return player
+
+# Guild Player
+class GuildPlayer:
+    # Initializes the playback state for a single guild.
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.vc = None
+        self.playlist = Playlist(MAX_QUEUE_SIZE, on_change=self._playlist_changed)
+        self.waiting = deque()  # Playlist songs waiting for room in the queue, see enqueue_playlist
+        self.current_track = None
+        self.mixer = None
+        self.volume_task = None
+        self.lock = asyncio.Lock()
+        self.advance_lock = asyncio.Lock()
+        self.generation = 0
+        self.text_channel = None
+        self.prefetch_event = asyncio.Event()
+        self.prefetch_task = None
+        self.restoring = None
+
+    # Returns True if the player has a live voice connection.
+    def is_connected(self):
+        return self.vc is not None and self.vc.is_connected()
+
+    # Returns True if the voice client is currently playing.
+    def is_playing(self):
+        return self.vc is not None and self.vc.is_playing()
+
+    # Returns a snapshot of the queued tracks.
+    def queue_items(self):
+        return self.playlist.items()
+
+    # Returns True if anyone other than bots is in the player's voice channel.
+    def has_listeners(self):
+        return self.is_connected() and any(not member.bot for member in self.vc.channel.members)
+
+    # Notifies registered listeners that this player's state changed.
+    def notify(self):
+        for listener in player_listeners:
+            try:
+                listener(self)
             except Exception as e:
-                logger.warning(f"Failed to terminate FFmpeg process {proc.info['pid']}: {e}")
+                logger.warning(f"Player listener error: {e}")
 
-# Bot Thread
-class BotThread(QThread):
-    ready_signal = pyqtSignal(bool)
+    # Connects to the given voice channel, or moves there if already connected.
+    async def connect(self, voice_channel):
+        if self.is_connected():
+            if self.vc.channel != voice_channel:
+                await self.vc.move_to(voice_channel)
+        else:
+            self.vc = await voice_channel.connect()
+        logger.info(f"Guild {self.guild_id}: connected to voice channel {voice_channel.name}.")
+        self.notify()
+
+    # Connects to the guild's default voice channel if not already connected.
+    async def ensure_connected(self, guild):
+        if self.is_connected():
+            return True
+        voice_channel = discord.utils.get(guild.voice_channels, name=VOICE_CHANNEL_NAME)
+        if not voice_channel:
+            logger.error(f"Guild {self.guild_id}: voice channel '{VOICE_CHANNEL_NAME}' not found!")
+            return False
+        await self.connect(voice_channel)
+        return True
+
+    # Stops playback, disconnects from voice and resets the playback state.
+    async def disconnect(self):
+        async with self.lock:
+            if self.vc:
+                if self.vc.is_playing() or self.vc.is_paused():
+                    self.vc.stop()
+                await self.vc.disconnect()
+                self.vc = None
+            self._release(self._clear_queue() + [self.current_track])
+            self.generation += 1
+            self.current_track, self.mixer = None, None
+            if self.prefetch_task:
+                self.prefetch_task.cancel()
+                self.prefetch_task = None
+            pids = process_supervisor.owned_by(self.guild_id)
+        await asyncio.get_running_loop().run_in_executor(None, process_supervisor.reap, pids)
+        self.notify()
+
+    # Hands music or a quick sound to the mixer feeding the voice client, starting a new mixer
+    # if the current one has finished. Must be called with the lock held.
+    def _mix(self, music=None, overlay=None, duration=None, gain=1.0, requested_at=None, start_frames=0):
+        if self.mixer and (self.vc.is_playing() or self.vc.is_paused()):
+            if music is not None and self.mixer.set_music(music, start_frames, duration, gain, requested_at):
+                return
+            if overlay is not None and self.mixer.add_overlay(overlay):
+                return
+        if self.vc.is_playing() or self.vc.is_paused():
+            self.vc.stop()
+        mixer = create_mixer(on_music_end=self._on_music_end, on_overlays_done=self._on_overlays_done,
+                             on_preload_due=self._on_preload_due)
+        if music is not None:
+            mixer.set_music(music, start_frames, duration, gain, requested_at)
+        if overlay is not None:
+            mixer.add_overlay(overlay)
+        self.mixer = mixer
+        self.vc.play(mixer, after=lambda error: self.after_playing(error, mixer))
+
+    # Returns True if a track is loaded in the mixer, playing or paused.
+    def music_active(self):
+        return self.mixer is not None and not self.mixer.ended and self.mixer.has_music()
+
+    # Returns the current track position in seconds.
+    def position(self):
+        return self.mixer.position() if self.music_active() else 0
+
+    # Opens a track that many 20ms frames in and reads its first frames, all off the event loop, so
+    # handing it to a playing mixer never stalls the audio thread while FFmpeg starts up.
+    async def _open_primed(self, track, start_frames=0):
+        position = start_frames * FRAME_SIZE / BYTES_PER_SECOND
+        future = asyncio.get_running_loop().run_in_executor(
+            None, lambda: PrimedSource(create_music_source(track, position, music_volume, self.guild_id)))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.add_done_callback(lambda done: done.exception() is None and done.result().cleanup())
+            raise
+
+    # Starts playing a track immediately, using its preloaded source if the mixer has one staged,
+    # else music if given (see _open_primed). start_frames starts it that many 20ms frames in.
+    # Must be called with the lock held.
+    def _start(self, track, start_frames=0, music=None):
+        self.current_track = track
+        gain = track_gain(track)
+        staged = self.mixer.take_next(track) if self.mixer and not start_frames else None
+        if staged is not None:
+            if music is not None:
+                music.cleanup()
+            music = staged
+        if music is None:
+            music = create_music_source(track, start_frames * FRAME_SIZE / BYTES_PER_SECOND, music_volume, self.guild_id)
+        self._mix(music=music, duration=track.duration, gain=gain, requested_at=track.requested_at, start_frames=start_frames)
+        logger.info(f"Guild {self.guild_id}: started playing {track.title}")
+
+    # Returns True if a new request would be the next thing heard: nothing is playing, nothing is
+    # queued and no song is being started. Only such requests are timed for time to first audio.
+    # Must be called with the lock held, before queueing.
+    def _idle(self):
+        return self.is_connected() and not self.music_active() and not len(self.playlist) and not self.advance_lock.locked()
+
+    # Adds a track to the queue without waiting for it to resolve, starting playback if the player is idle.
+    # Returns the track's position in the queue; raises PlaylistFull if there is no room.
+    async def enqueue(self, track):
+        async with self.lock:
+            if not self._idle():
+                track.requested_at = None
+            position = self.playlist.append(track)
+            idle = self.is_connected() and not self.music_active()
+            if self.mixer and self.mixer.next_music is None:
+                self.mixer.preload_requested = False
+        if idle:
+            asyncio.create_task(self.play_next())
+        self.kick_prefetch()
+        return position
+
+    # Adds several tracks at once, as many as fit in the queue, starting playback if the player is idle.
+    # Returns the position of the first one and how many were added.
+    async def enqueue_many(self, tracks):
+        async with self.lock:
+            for track in tracks[1:] if self._idle() else tracks:
+                track.requested_at = None
+            position, added = self.playlist.extend(tracks)
+            idle = self.is_connected() and not self.music_active()
+            if self.mixer and self.mixer.next_music is None:
+                self.mixer.preload_requested = False
+        if added and idle:
+            asyncio.create_task(self.play_next())
+        self.kick_prefetch()
+        return position, added
+
+    # Queues the entries of a YouTube playlist, up to MAX_PLAYLIST_SIZE, as placeholders. Only the
+    # first few are resolved, by the prefetcher; the rest resolve as they come up. Entries that do not
+    # fit in the queue wait in order and join it as it plays. Returns a summary message for the channel.
+    async def enqueue_playlist(self, url, mode=DEFAULT_PLAY_MODE, requester=None):
+        title, entries = await asyncio.get_running_loop().run_in_executor(None, fetch_playlist, url, MAX_PLAYLIST_SIZE)
+        if not entries:
+            return f"No songs found in {title}."
+        tracks = [
+            Track(None, entry.get('title') or entry['id'], video_id=entry['id'],
+                  query=f"https://www.youtube.com/watch?v={entry['id']}", mode=mode,
+                  duration=entry.get('duration'), requester=requester)
+            for entry in entries
+        ]
+        position, added = await self.enqueue_many(tracks)
+        async with self.lock:
+            self.waiting.extend(tracks[added:])
+            self._top_up()
+        waiting = len(tracks) - added
+        logger.info(f"Guild {self.guild_id}: queued {len(tracks)} song(s) from playlist {title}, {waiting} waiting for room")
+        songs = "1 song" if added == 1 else f"{added} songs"
+        message = f"Added {songs} from {title} to the queue (#{position}-#{position + added - 1})." if added else "The queue is full."
+        if waiting:
+            more = "1 more song" if waiting == 1 else f"{waiting} more songs"
+            message += f" {more} from {title} will join it as it plays."
+        elif len(self.playlist) >= self.playlist.capacity:
+            message += " The queue is now full."
+        return message
+
+    # Moves playlist songs waiting for room into the queue while it has some. Must be called with the lock held.
+    def _top_up(self):
+        room = self.playlist.capacity - len(self.playlist)
+        if self.waiting and room > 0:
+            self.playlist.extend([self.waiting.popleft() for _ in range(min(room, len(self.waiting)))])
+
+    # Empties the queue and the playlist songs waiting for room in it, returning both. Must be called with the lock held.
+    def _clear_queue(self):
+        tracks = self.playlist.clear() + list(self.waiting)
+        self.waiting.clear()
+        return tracks
+
+    # Removes the queued track at a 0-based index and cancels its download. Raises IndexError if there is none.
+    async def remove(self, index):
+        async with self.lock:
+            track = self.playlist.remove(index)
+            self._release([track])
+        return track
+
+    # Moves a queued track to a new 0-based index. Raises IndexError if either is out of range.
+    async def move(self, index, new_index):
+        async with self.lock:
+            return self.playlist.move(index, new_index)
+
+    # Puts the queue, and the playlist songs waiting to join it, in random order.
+    async def shuffle(self):
+        async with self.lock:
+            random.shuffle(self.waiting)
+            self.playlist.shuffle()
+
+    # Empties the queue, cancelling its downloads, and leaves the current song playing. Returns how many songs were removed.
+    async def clear(self):
+        async with self.lock:
+            tracks = self._clear_queue()
+            self._release(tracks)
+        return len(tracks)
+
+    # Returns the session to save for a warm restart: the voice and text channels, the current
+    # track and how many frames of it have been played, whether it is paused, and the queue.
+    # Returns None when not connected. While a saved session is being picked up it is returned as it was.
+    def snapshot(self):
+        if not self.is_connected():
+            return None
+        if self.restoring is not None:
+            return self.restoring
+        session = {
+            'channel_id': self.vc.channel.id,
+            'text_channel_id': self.text_channel.id if self.text_channel else None,
+            'queue': [track.to_dict() for track in self.queue_items() + list(self.waiting) if track.state != "cancelled"],
+        }
+        if self.current_track and self.music_active():
+            session['current'] = self.current_track.to_dict()
+            session['frames'] = self.mixer.music_frames
+            session['paused'] = self.mixer.music_paused
+        return session
+
+    # Picks up a saved session once connected: queues the saved tracks and starts the current one
+    # at the saved frame, paused if it was.
+    async def restore(self, session):
+        self.restoring = session
+        try:
+            await self._restore(session)
+        finally:
+            self.restoring = None
+        self.notify()
+
+    # Queues and starts the tracks of a saved session.
+    async def _restore(self, session):
+        tracks = [track for track in map(Track.from_dict, session.get('queue', [])) if track]
+        current = Track.from_dict(session['current']) if session.get('current') else None
+        for track in tracks + [current]:
+            if track:
+                track.requested_at = None
+        async with self.lock:
+            position, added = self.playlist.extend(tracks)
+            self.waiting.extend(tracks[added:])
+        self.kick_prefetch()
+        if current is None:
+            await self.play_next()
+            return
+        async with self.advance_lock:
+            await self._resume(current, session.get('frames', 0), session.get('paused', False))
+        if not self.music_active():
+            await self.play_next()
+
+    # Starts a track that many 20ms frames in, paused if asked, unless the player is stopped or
+    # something else starts meanwhile. Reports the track as failed if it cannot be opened.
+    # Returns True if it started. Must be called with the advance lock held.
+    async def _resume(self, track, frames, paused=False):
+        generation = self.generation
+        music = None
+        if await self._prepare_for_playback(track):
+            try:
+                music = await self._open_primed(track, frames)
+            except Exception as e:
+                track.error = f"Could not open the audio: {e}"
+        if music is None:
+            await self._report_failure(track)
+            return False
+        async with self.lock:
+            if generation != self.generation or not self.is_connected() or self.music_active():
+                music.cleanup()
+                return False
+            self._start(track, frames, music)
+            if paused:
+                self.mixer.music_paused = True
+                self.vc.pause()
+        logger.info(f"Guild {self.guild_id}: resumed {track.title} at {self.position():.1f}s")
+        if track.is_stream and CACHE_STREAMED_SONGS:
+            self.download(track)
+        return True
+
+    # Reacts to queue changes: refills the room left by a song from the playlist songs waiting for it,
+    # drops a preloaded track that is no longer next, points the prefetcher at the new head of the
+    # queue and tells listeners.
+    def _playlist_changed(self, kind, track):
+        if kind in ("pop", "remove"):
+            self._top_up()
+        if kind in ("remove", "move", "shuffle", "clear"):
+            if self.mixer and self.mixer.next_track is not None and self.mixer.next_track is not self.playlist.peek():
+                self.mixer.clear_next()
+            if kind != "clear":
+                self.kick_prefetch()
+        self.notify()
+
+    # Plays the next song in the queue if available, resolving it first if prefetch has not reached it yet.
+    async def play_next(self):
+        async with self.advance_lock:
+            while True:
+                async with self.lock:
+                    if not self.vc or self.music_active():
+                        return
+                    track = self.playlist.popleft()
+                    if track is None:
+                        logger.info(f"Guild {self.guild_id}: queue empty.")
+                        self.current_track = None
+                        break
+                    generation = self.generation
+                self.kick_prefetch()
+                if not await self._prepare_for_playback(track):
+                    await self._report_failure(track)
+                    continue
+                music = None
+                if not (self.mixer and self.mixer.next_track is track):
+                    try:
+                        music = await self._open_primed(track)
+                    except Exception as e:
+                        track.error = f"Could not open the audio: {e}"
+                        await self._report_failure(track)
+                        continue
+                async with self.lock:
+                    if generation != self.generation or not self.is_connected() or self.music_active():
+                        if music is not None:
+                            music.cleanup()
+                        return
+                    self._start(track, music=music)
+                if track.is_stream and CACHE_STREAMED_SONGS:
+                    self.download(track)
+                break
+        self.notify()
+
+    # Makes a track playable now: streams resolve to a URL, everything else waits for its download.
+    async def _prepare_for_playback(self, track):
+        if track.state == "ready" and track.is_available():
+            return True
+        if track.mode == "stream":
+            resolved, message = await asyncio.get_running_loop().run_in_executor(None, resolve_stream, track.query)
+            if resolved:
+                track.resolved(resolved.source, resolved.title, resolved.video_id, resolved.is_stream, resolved.codec)
+                track.duration = resolved.duration or track.duration
+                return True
+            logger.warning(f"Streaming failed for {track.query} ({message}), falling back to download.")
+        return await self.download(track, PRIORITY_NOW)
+
+    # Starts downloading a track into the cache at the given priority, or returns the download
+    # already in flight for it after moving it up to that priority. A finished download whose file
+    # has gone since, e.g. evicted from the cache, is started again.
+    def download(self, track, priority=PRIORITY_PREFETCH):
+        if track.download_future is None or (track.download_future.done() and not track.is_available()):
+            track.priority = priority
+            track.download_future = asyncio.ensure_future(self._download(track))
+        elif priority < track.priority:
+            track.priority = priority
+            if track.video_id:
+                download_scheduler.reprioritize(track.video_id, priority)
+        return track.download_future
+
+    # Marks tracks as removed and cancels any downloads only they were waiting for.
+    def _release(self, tracks):
+        for track in tracks:
+            if track is None:
+                continue
+            if track.state != "ready":
+                track.state = "cancelled"
+            if track.video_id:
+                download_scheduler.release(track, track.video_id)
+
+    # Resolves and downloads a track, returning True once it points at a local file.
+    async def _download(self, track):
+        loop = asyncio.get_running_loop()
+        track.error = None
+        if not track.query:
+            return track.is_available()
+        try:
+            if track.video_id is None:
+                video = await loop.run_in_executor(None, resolve_song, track.query)
+                if not video:
+                    track.state, track.error = "failed", "No video found."
+                    return False
+                track.video_id = video['id']
+                track.duration = video.get('duration') or track.duration
+                if track.state == "pending":
+                    track.title = video['title']
+                    self.notify()
+            if track.state == "cancelled":
+                return False
+            file_path, message = await download_scheduler.submit(track.video_id, track.query, track.title, track, track.priority)
+        except Exception as e:
+            file_path, message = None, f"Error downloading: {e}"
+        if not file_path:
+            if not track.is_available() and track.state != "cancelled":
+                track.state, track.error = "failed", message
+            return False
+        track.resolved(file_path, message, track.video_id)
+        return True
+
+    # Tells the requesting channel that a queued track could not be played.
+    async def _report_failure(self, track):
+        logger.error(f"Guild {self.guild_id}: could not play {track.title}: {track.error}")
+        if self.text_channel:
+            try:
+                await self.text_channel.send(f"Could not play {track.title}: {track.error}")
+            except discord.HTTPException as e:
+                logger.warning(f"Failed to report playback error: {e}")
+
+    # Wakes the prefetcher, starting it if it is not running yet.
+    def kick_prefetch(self):
+        if self.prefetch_task is None or self.prefetch_task.done():
+            self.prefetch_task = asyncio.create_task(self._prefetch_loop())
+        self.prefetch_event.set()
+
+    # Downloads the next PREFETCH_DEPTH queued tracks in the background while someone is listening.
+    async def _prefetch_loop(self):
+        while True:
+            await self.prefetch_event.wait()
+            self.prefetch_event.clear()
+            for index, track in enumerate(self.queue_items()[:PREFETCH_DEPTH]):
+                if not self.has_listeners():
+                    logger.info(f"Guild {self.guild_id}: nobody in voice, prefetch paused.")
+                    break
+                if track.state == "pending":
+                    self.download(track, PRIORITY_NEXT if index == 0 else PRIORITY_PREFETCH)
+
+    # Called from the audio thread when the mixer's music layer runs out. If the mixer already
+    # switched to the preloaded track, that track is passed in and only the bookkeeping is left.
+    def _on_music_end(self, next_track=None):
+        if next_track is not None:
+            asyncio.run_coroutine_threadsafe(self._handoff(next_track), bot.loop)
+        else:
+            asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
+
+    # Records that the mixer moved on to a preloaded track.
+    async def _handoff(self, track):
+        async with self.lock:
+            self.playlist.popleft(track)
+            self.current_track = track
+        logger.info(f"Guild {self.guild_id}: started playing {track.title}")
+        self.notify()
+        self.kick_prefetch()
+        if track.is_stream and CACHE_STREAMED_SONGS:
+            self.download(track)
+
+    # Called from the audio thread when the current track nears its end.
+    def _on_preload_due(self):
+        asyncio.run_coroutine_threadsafe(self._preload_next(), bot.loop)
+
+    # Opens the next queued track and reads its first frames ahead of time, then stages it in the
+    # mixer so playback carries straight on when the current track ends.
+    async def _preload_next(self):
+        async with self.lock:
+            track = self.playlist.peek()
+            if track is None or not self.music_active() or self.mixer.next_music is not None:
+                return
+            mixer, generation = self.mixer, self.generation
+        if not await self._prepare_for_playback(track):
+            return
+        gain = track_gain(track)
+        try:
+            source = await self._open_primed(track)
+        except Exception as e:
+            logger.warning(f"Guild {self.guild_id}: could not preload {track.title}: {e}")
+            return
+        async with self.lock:
+            staged = (generation == self.generation and mixer is self.mixer and self.playlist.peek() is track
+                      and mixer.set_next(source, track, track.duration, gain, track.requested_at))
+        if not staged:
+            source.cleanup()
+
+    # Called from the audio thread when the last quick sound finishes; re-pauses if music was paused.
+    def _on_overlays_done(self):
+        asyncio.run_coroutine_threadsafe(self._repause(), bot.loop)
+
+    # Pauses the voice client again after quick sounds played over paused music.
+    async def _repause(self):
+        async with self.lock:
+            if self.mixer and self.mixer.music_paused and not self.mixer.overlays and self.vc and self.vc.is_playing():
+                self.vc.pause()
+
+    # Callback function to handle the end of playback and trigger the next song.
+    def after_playing(self, error, mixer=None):
+        if error:
+            logger.error(f"Playback error: {error}")
+        asyncio.run_coroutine_threadsafe(self._mixer_finished(mixer), bot.loop)
+
+    # Forgets a finished mixer and moves on to the next song. If its audio worker failed mid-song,
+    # the song is picked up where it stopped on a new mixer and worker instead.
+    async def _mixer_finished(self, mixer):
+        async with self.lock:
+            current = mixer is not None and self.mixer is mixer
+            if current:
+                self.mixer = None
+            track = self.current_track if current and mixer.cut_off else None
+        if track is not None:
+            logger.warning(f"Guild {self.guild_id}: audio worker failed, picking up {track.title} on a new one.")
+            async with self.advance_lock:
+                await self._resume(track, mixer.music_frames, mixer.music_paused)
+        await self.play_next()
+
+    # Pauses the currently playing song. Returns True if something was paused.
+    async def pause(self):
+        async with self.lock:
+            if self.vc and self.vc.is_playing() and self.music_active():
+                self.mixer.music_paused = True
+                self.vc.pause()
+                return True
+        return False
+
+    # Resumes a paused song. Returns True if something was resumed.
+    async def resume(self):
+        async with self.lock:
+            if self.vc and self.mixer and self.mixer.music_paused:
+                self.mixer.music_paused = False
+                if self.vc.is_paused():
+                    self.vc.resume()
+                return True
+        return False
+
+    # Stops playback, clears the queue and waits for the guild's FFmpeg processes to exit.
+    async def stop(self):
+        async with self.lock:
+            self._release(self._clear_queue() + [self.current_track])
+            self.generation += 1
+            if self.vc and (self.vc.is_playing() or self.vc.is_paused()):
+                self.vc.stop()
+            self.current_track, self.mixer = None, None
+            pids = process_supervisor.owned_by(self.guild_id)
+        await asyncio.get_running_loop().run_in_executor(None, process_supervisor.reap, pids)
+        self.notify()
+
+    # Skips the current song, leaving quick sounds playing. Returns True if something was playing.
+    async def skip(self):
+        async with self.lock:
+            if not self.music_active():
+                return False
+            self._release([self.current_track])
+            self.mixer.music_paused = False
+            self.mixer.set_music(None)
+            preloaded = self.mixer.next_music is not None
+            if self.vc.is_paused():
+                self.vc.resume()
+        if not preloaded:
+            await self.play_next()
+        return True
+
+    # Applies a new music volume to the current mix. Opus music has its gain applied inside
+    # FFmpeg, so it is reopened at the current position once the slider settles.
+    async def set_volume(self, new_volume):
+        async with self.lock:
+            if self.mixer:
+                self.mixer.volume = new_volume
+                if self.mixer.next_is_opus:
+                    self.mixer.clear_next()
+                if self.mixer.music_is_opus:
+                    if self.volume_task:
+                        self.volume_task.cancel()
+                    self.volume_task = asyncio.create_task(self._reopen_with_gain())
+
+    # Reopens the current Opus track with the current music volume baked into FFmpeg. The new source
+    # is opened and primed while the old one keeps playing, then skips what was played meanwhile.
+    async def _reopen_with_gain(self):
+        await asyncio.sleep(VOLUME_RESTART_DELAY)
+        async with self.lock:
+            if not self.music_active() or not self.mixer.music_is_opus or not self.current_track:
+                return
+            track, mixer, frames, gain = self.current_track, self.mixer, self.mixer.music_frames, self.mixer.music_gain
+        try:
+            source = await self._open_primed(track, frames)
+        except Exception as e:
+            logger.warning(f"Guild {self.guild_id}: could not reopen {track.title} at the new volume: {e}")
+            return
+        async with self.lock:
+            if self.mixer is not mixer or self.current_track is not track or not self.music_active() or not mixer.music_is_opus:
+                source.cleanup()
+                return
+            played = mixer.music_frames
+            source.skip(played - frames)
+            mixer.set_music(source, start_frames=played, duration=mixer.music_duration, gain=gain)
+
+    # Applies a new quick sound volume to the current mix.
+    async def set_quick_sound_volume(self, new_volume):
+        async with self.lock:
+            if self.mixer:
+                self.mixer.overlay_volume = new_volume
+
+    # Plays a quick sound from the soundboard's memory over whatever music is playing.
+    async def play_quick_sound(self, name):
+        pcm = soundboard.cached(name)
+        if pcm is None:
+            pcm = await asyncio.get_running_loop().run_in_executor(None, soundboard.get, name)
+            if pcm is None:
+                logger.warning(f"Cannot play quick sound: {name} could not be loaded.")
+                return
+        async with self.lock:
+            if not self.is_connected():
+                logger.warning("Cannot play quick sound: Bot is not connected to a voice channel.")
+                return
+            try:
+                self._mix(overlay=PCMBufferAudio(pcm))
+                if self.vc.is_paused():
+                    self.vc.resume()
+            except Exception as e:
+                logger.error(f"Quick sound error: {e}")
+
+# Disconnects a guild from voice and, once no guild is using them, has the janitor stop the FFmpeg
+# processes and clear the temp folder in the background.
+async def disconnect_and_cleanup(player):
+    await player.disconnect()
+    if any(p.is_connected() for p in players.values()):
+        logger.info("Other guilds still connected, keeping temp folder.")
+        return
+    janitor.sweep(reap=True)
+
+# Sessions
+class SessionStore:
+    # Initializes the store of the sessions a restart picks up again, saved to path.
+    def __init__(self, path):
+        self.path = path
+        self.last_saved = None
+        self.closed = False
+        self.task = None
+
+    # Collects the snapshot of every connected guild and the volumes.
+    def collect(self):
+        guilds = {}
+        for guild_id, player in list(players.items()):
+            session = player.snapshot()
+            if session:
+                guilds[str(guild_id)] = session
+        return {'music_volume': music_volume, 'quick_sound_volume': quick_sound_volume, 'guilds': guilds}
+
+    # Writes a snapshot if anything changed since the last one. The file is written off the event loop.
+    async def save(self):
+        if self.closed or not self.path:
+            return
+        data = self.collect()
+        if data == self.last_saved:
+            return
+        self.last_saved = data
+        await asyncio.get_running_loop().run_in_executor(None, self._write, dict(data, saved_at=time.time()))
+
+    # Resumes the saved sessions if RESUME_SESSIONS is set, then saves a snapshot every SESSION_SNAPSHOT_INTERVAL seconds.
+    async def run(self):
+        if RESUME_SESSIONS:
+            try:
+                await self.resume()
+            except Exception as e:
+                logger.error(f"Failed to resume sessions: {e}")
+        while True:
+            await asyncio.sleep(SESSION_SNAPSHOT_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.warning(f"Failed to save sessions: {e}")
+
+    # Saves a last snapshot and stops saving, so the disconnects of a shutdown are not recorded.
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        await self.save()
+        self.closed = True
+
+    # Starts resuming and saving sessions on the running event loop, once.
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    # Rejoins the voice channels of the saved sessions and carries on playing where they stopped.
+    async def resume(self):
+        global music_volume, quick_sound_volume
+        data = await asyncio.get_running_loop().run_in_executor(None, self._read)
+        if not data:
+            return
+        if time.time() - data.get('saved_at', 0) > SESSION_MAX_AGE:
+            logger.info("Saved sessions are too old, not resuming them.")
+            return
+        music_volume = data.get('music_volume', music_volume)
+        quick_sound_volume = data.get('quick_sound_volume', quick_sound_volume)
+        for guild_id, session in data.get('guilds', {}).items():
+            guild = bot.get_guild(int(guild_id))
+            channel = guild.get_channel(session['channel_id']) if guild else None
+            if not isinstance(channel, discord.VoiceChannel):
+                logger.info(f"Guild {guild_id}: saved voice channel is gone, not resuming.")
+                continue
+            player = get_player(guild.id)
+            if player.is_connected():
+                continue
+            try:
+                await player.connect(channel)
+            except (discord.ClientException, asyncio.TimeoutError) as e:
+                logger.warning(f"Guild {guild_id}: could not rejoin {channel.name}: {e}")
+                continue
+            if session.get('text_channel_id'):
+                player.text_channel = guild.get_channel(session['text_channel_id'])
+            asyncio.create_task(player.restore(session))
+        control_api.notify()
+
+    # Reads the saved sessions, or returns None if there are none.
+    def _read(self):
+        if not self.path:
+            return None
+        try:
+            with open(self.path, "r", encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read sessions {self.path}: {e}")
+            return None
+
+    # Replaces the saved sessions with a new snapshot.
+    def _write(self, data):
+        tmp_file = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_file, "w", encoding='utf-8') as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_file, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to write sessions {self.path}: {e}")
+
+session_store = SessionStore(SESSION_FILE)
 
-    # Initializes the BotThread with an optional parent.
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.main_window = None
+# Saves the sessions for the next start, then logs the bot out and leaves voice.
+async def close_bot():
+    try:
+        await session_store.close()
+    finally:
+        await bot.close()
+
+# Control API
+class ControlError(Exception):
+    # Initializes an error answered with the given HTTP status.
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ControlAPI:
+    # Initializes the API. Requests are answered once start() is called and handed to the bot loop once it is set.
+    def __init__(self, host, port, token=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.loop = None
+        self.server = None
+        self.version = 0
+        self.changed = threading.Condition()
+
+    # Starts serving in a background thread. Returns False if the port could not be opened.
+    def start(self):
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), ControlHandler)
+        except OSError as e:
+            logger.error(f"Failed to start control API on {self.host}:{self.port}: {e}")
+            return False
+        self.server.daemon_threads = True
+        self.server.api = self
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="control-api", daemon=True).start()
+        logger.info(f"Control API listening at http://{self.host}:{self.port}")
+        return True
+
+    # Stops serving.
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    # Bumps the state version and wakes clients waiting for a change. Safe to call from any thread.
+    def notify(self, *args):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    # Blocks until the state version is past since or timeout runs out. Returns True if it changed.
+    def wait(self, since, timeout):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.version > since, timeout)
+
+    # Runs a coroutine on the bot loop and returns its result. Called from request threads.
+    def call(self, coro):
+        if self.loop is None or not bot.is_ready():
+            coro.close()
+            raise ControlError(503, "The bot is not logged in yet.")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(CONTROL_CALL_TIMEOUT)
+
+    # Routes a request and returns the JSON-able answer.
+    def handle(self, method, path, query, body):
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if method == "GET" and parts == ["state"]:
+            since = int(query.get('since', ["-1"])[0])
+            if since >= 0 and self.wait(since, CONTROL_POLL_TIMEOUT):
+                time.sleep(CONTROL_COALESCE_SECONDS)
+            if self.loop is None or not bot.is_ready():
+                return {'version': self.version, 'ready': False, 'guilds': []}
+            return self.call(self.state())
+        if method == "GET" and parts == ["stats"]:
+            return {'lines': metrics.summary_lines()}
+        if method == "POST" and parts == ["volume"]:
+            return self.call(self.set_volumes(body.get('music'), body.get('quick_sound')))
+        if method == "PUT" and len(parts) == 2 and parts[0] == "quick-sounds":
+            file_path = body.get('path')
+            if not file_path or not os.path.isfile(file_path):
+                raise ControlError(400, f"No such file: {file_path}")
+            soundboard.assign(parts[1], file_path)
+            self.notify()
+            return {}
+        if method == "POST" and len(parts) == 3 and parts[0] == "guilds":
+            return self.call(self.guild_action(int(parts[1]), parts[2], body))
+        raise ControlError(404, f"No such endpoint: {method} {path}")
+
+    # Returns what a control panel shows: each guild's connection and queue, the volumes and the quick sounds.
+    async def state(self):
+        version = self.version
+        guilds = []
+        for guild in bot.guilds:
+            player = players.get(guild.id)
+            guilds.append({
+                'id': guild.id,
+                'name': guild.name,
+                'connected': bool(player and player.is_connected()),
+                'playing': bool(player and player.is_playing()),
+                'paused': bool(player and player.mixer and player.mixer.music_paused),
+                'current': player.current_track.summary() if player and player.current_track else None,
+                'queue': [{'id': track.track_id, 'summary': track.summary()} for track in player.queue_items()] if player else [],
+            })
+        return {
+            'version': version,
+            'ready': True,
+            'guilds': guilds,
+            'music_volume': music_volume,
+            'quick_sound_volume': quick_sound_volume,
+            'quick_sounds': dict(soundboard.assignments),
+        }
+
+    # Sets the music and/or quick sound volume (0-1) for every guild.
+    async def set_volumes(self, music=None, quick_sound=None):
+        global music_volume, quick_sound_volume
+        if music is not None:
+            music_volume = min(1.0, max(0.0, float(music)))
+            for player in list(players.values()):
+                await player.set_volume(music_volume)
+        if quick_sound is not None:
+            quick_sound_volume = min(1.0, max(0.0, float(quick_sound)))
+            for player in list(players.values()):
+                await player.set_quick_sound_volume(quick_sound_volume)
+        self.notify()
+        return {'music_volume': music_volume, 'quick_sound_volume': quick_sound_volume}
+
+    # Runs one of the window's controls for a guild.
+    async def guild_action(self, guild_id, action, body):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            raise ControlError(404, f"The bot is not in a server with ID {guild_id}.")
+        player = get_player(guild_id)
+        if action == "connect":
+            if not await player.ensure_connected(guild):
+                raise ControlError(409, f"Voice channel '{VOICE_CHANNEL_NAME}' not found!")
+            return {}
+        if action == "disconnect":
+            await disconnect_and_cleanup(player)
+            return {}
+        if action in ("pause", "resume", "skip"):
+            return {'done': await getattr(player, action)()}
+        if action == "stop":
+            await player.stop()
+            return {}
+        if action == "quick-sound":
+            name = body.get('name')
+            if not soundboard.path(name):
+                raise ControlError(404, f"No sound assigned to {name}.")
+            await player.play_quick_sound(name)
+            return {}
+        if action == "queue":
+            return await self.enqueue(player, body)
+        raise ControlError(404, f"No such action: {action}")
+
+    # Queues a local file ({"path"}) or a search or link ({"query", optional "mode"}) for a guild.
+    # A query without a mode plays from the music library if it has the song.
+    async def enqueue(self, player, body):
+        try:
+            if body.get('path'):
+                if not os.path.isfile(body['path']):
+                    raise ControlError(400, f"No such file: {body['path']}")
+                track = Track(body['path'], body.get('title') or os.path.basename(body['path']), requester=body.get('requester'))
+                return {'position': await player.enqueue(track)}
+            query = (body.get('query') or "").strip()
+            if not query:
+                raise ControlError(400, "Give a path or a query.")
+            mode = body.get('mode') or DEFAULT_PLAY_MODE
+            if mode not in PLAY_MODE_FLAGS.values():
+                raise ControlError(400, f"Unknown play mode: {mode}")
+            if is_playlist_url(query):
+                return {'message': await player.enqueue_playlist(query, mode, body.get('requester'))}
+            track = None
+            if not body.get('mode'):
+                track = await asyncio.get_running_loop().run_in_executor(None, library_track, query, body.get('requester'))
+            if track is None:
+                track = Track(None, query, query=query, mode=mode, requester=body.get('requester'))
+            return {'position': await player.enqueue(track)}
+        except PlaylistFull:
+            raise ControlError(409, "Queue is full.")
+
+control_api = ControlAPI(CONTROL_HOST, CONTROL_PORT, CONTROL_TOKEN)
+player_listeners.append(control_api.notify)
+
+# Answers control API requests with JSON.
+class ControlHandler(BaseHTTPRequestHandler):
+    # Answers GET requests.
+    def do_GET(self):
+        self.respond("GET")
+
+    # Answers POST requests.
+    def do_POST(self):
+        self.respond("POST")
+
+    # Answers PUT requests.
+    def do_PUT(self):
+        self.respond("PUT")
+
+    # Checks that the request was addressed to this machine by name, the token and, for changes,
+    # that the body is JSON so a web page cannot post to the API.
+    def check_access(self, api, method):
+        if urlparse(f"//{self.headers.get('Host', '')}").hostname not in CONTROL_HOST_NAMES:
+            raise ControlError(403, "Use http://127.0.0.1 or http://localhost to reach the control API.")
+        if api.token and self.headers.get("Authorization") != f"Bearer {api.token}":
+            raise ControlError(401, "Missing or wrong token.")
+        if method != "GET" and self.headers.get_content_type() != "application/json":
+            raise ControlError(415, "Send a JSON body.")
+
+    # Handles a request and writes the answer, or {"error": ...} with a matching status.
+    def respond(self, method):
+        api = self.server.api
+        try:
+            self.check_access(api, method)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            url = urlparse(self.path)
+            status, answer = 200, api.handle(method, url.path, parse_qs(url.query), body)
+        except ControlError as e:
+            status, answer = e.status, {'error': str(e)}
+        except TimeoutError:
+            status, answer = 504, {'error': "The bot did not answer in time."}
+        except (ValueError, TypeError, AttributeError) as e:
+            status, answer = 400, {'error': f"Bad request: {e}"}
+        except Exception as e:
+            logger.error(f"Control API error for {method} {self.path}: {e}")
+            status, answer = 500, {'error': str(e)}
+        data = json.dumps(answer).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Keeps the control panel's polling out of the bot's log.
+    def log_message(self, format, *args):
+        pass
+
+# Slash Commands
+# Shortens text to fit a slash command choice.
+def choice_text(text, limit=100):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+# Suggests songs for /play from the music library and the audio and resolution caches, so picking
+# one needs no YouTube search. Library songs come first, then cached titles starting with what was
+# typed, then titles containing it.
+def play_choices(current):
+    text = current.casefold().strip()
+    seen = set()
+    starts, contains = [], []
+    library = [app_commands.Choice(name=choice_text(song.display_name()), value=choice_text(song.display_name()))
+               for song in music_library.suggest(current)] if text else []
+    candidates = [(video_id, title, video_url(video_id)) for video_id, title in audio_cache.titles()]
+    candidates += [(video['id'], video['title'], query if len(query) <= 100 else video_url(video['id']))
+                   for query, video in resolution_cache.known()]
+    for video_id, title, value in candidates:
+        if video_id in seen:
+            continue
+        folded = title.casefold()
+        if folded.startswith(text):
+            starts.append(app_commands.Choice(name=choice_text(title), value=value))
+        elif text in folded:
+            contains.append(app_commands.Choice(name=choice_text(title), value=value))
+        else:
+            continue
+        seen.add(video_id)
+        if len(library) + len(starts) >= AUTOCOMPLETE_LIMIT:
+            break
+    return (library + starts + contains)[:AUTOCOMPLETE_LIMIT]
+
+# Suggests queue positions, shown with the song at each, for the commands that edit the queue.
+def queue_choices(guild_id, current):
+    player = players.get(guild_id)
+    if player is None:
+        return []
+    text = str(current).casefold().strip()
+    choices = []
+    for position, track in enumerate(player.queue_items(), 1):
+        name = f"{position}. {track.title}"
+        if text in name.casefold():
+            choices.append(app_commands.Choice(name=choice_text(name), value=position))
+            if len(choices) >= AUTOCOMPLETE_LIMIT:
+                break
+    return choices
+
+# Registers the slash commands with Discord if they changed since the last time. Discord limits
+# how often commands may be synced, so a fingerprint of what was sent is kept in COMMAND_SYNC_FILE.
+async def sync_app_commands():
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands()), key=lambda command: command['name'])
+    fingerprint = hashlib.sha256(json.dumps([bot.application_id, payload], sort_keys=True).encode('utf-8')).hexdigest()
+    try:
+        with open(COMMAND_SYNC_FILE, "r", encoding='utf-8') as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return
+    except (OSError, ValueError):
+        pass
+    try:
+        synced = await bot.tree.sync()
+    except discord.HTTPException as e:
+        logger.warning(f"Failed to register slash commands: {e}")
+        return
+    logger.info(f"Registered {len(synced)} slash command(s); they can take a few minutes to show up.")
+    try:
+        os.makedirs(os.path.dirname(COMMAND_SYNC_FILE), exist_ok=True)
+        with open(COMMAND_SYNC_FILE, "w", encoding='utf-8') as f:
+            json.dump({'fingerprint': fingerprint}, f)
+    except OSError as e:
+        logger.warning(f"Failed to write {COMMAND_SYNC_FILE}: {e}")
 
-    # Runs the bot's asyncio event loop.
+# Bot Thread
+class BotThread(threading.Thread):
+    # Initializes the thread the bot's event loop runs on.
+    def __init__(self):
+        super().__init__(name="bot", daemon=True)
+        self.lag_task = None
+        self.sync_task = None
+
+    # Runs the bot's asyncio event loop. Headless mode calls this directly on the main thread.
     def run(self):
         asyncio.run(self.start_bot())
 
     # Starts the Discord bot and defines its commands and events.
     async def start_bot(self):
-        # Handles the bot's on_ready event, logging login and enabling the connect button.
+        loop = asyncio.get_running_loop()
+        control_api.loop = loop
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                with contextlib.suppress(NotImplementedError):
+                    loop.add_signal_handler(sig, lambda: asyncio.ensure_future(close_bot()))
+
+        # Handles the bot's on_ready event, logging login, telling control clients and resuming saved sessions.
         @bot.event
         async def on_ready():
             logger.info(f"Bot logged in as {bot.user}")
             logger.info(f"Connected to {len(bot.guilds)} guild(s)" if bot.guilds else "No guilds connected!")
-            self.ready_signal.emit(True)
+            control_api.notify()
+            asyncio.get_running_loop().run_in_executor(None, soundboard.preload)
+            if self.lag_task is None:
+                self.lag_task = asyncio.create_task(monitor_loop_lag())
+            if self.sync_task is None:
+                self.sync_task = asyncio.create_task(sync_app_commands())
+            session_store.start()
+
+        # Tells control clients the server list changed.
+        @bot.event
+        async def on_guild_join(guild):
+            control_api.notify()
 
-        # Plays a song by downloading it and adding it to the queue or playing immediately.
-        @bot.command(name="play")
+        # Tells control clients the server list changed.
+        @bot.event
+        async def on_guild_remove(guild):
+            control_api.notify()
+
+        # Queues a song right away; it is streamed or downloaded when prefetch or playback reaches it.
+        # Prefix the song with --stream or --download to pick the mode for this request.
+        # A playlist link queues its songs, as many as fit.
+        @bot.hybrid_command(name="play", description="Queue a song by name or link, or a playlist link.")
+        @app_commands.describe(song_title="Song name or YouTube link; start with --stream or --download to pick how it is played")
+        @commands.guild_only()
         async def play(ctx, *, song_title):
-            global vc, file_queue
+            requested_at = time.monotonic()
+            player = get_player(ctx.guild.id)
+            await ctx.defer()
             try:
-                file_path, message = await asyncio.get_running_loop().run_in_executor(None, download_song, song_title)
-                if not file_path:
-                    await ctx.send(message)
+                request = song_title
+                mode, song_title = parse_play_mode(song_title)
+                if not await player.ensure_connected(ctx.guild):
+                    await ctx.send(f"Voice channel '{VOICE_CHANNEL_NAME}' not found!")
                     return
-
-                await ctx.send(f"Added to queue: {message}")
-                if not vc or not vc.is_connected():
-                    voice_channel = discord.utils.get(ctx.guild.voice_channels, name="tutturu~")
-                    if not voice_channel:
-                        await ctx.send("Voice channel 'tutturu~' not found!")
-                        return
-                    vc = await voice_channel.connect()
-
-                async with vc_lock:
-                    if vc.is_playing():
-                        file_queue.put(file_path)
-                    else:
-                        global current_file, start_time
-                        current_file = file_path
-                        source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(file_path), volume=music_volume)
-                        vc.play(source, after=self._play_next_callback)
-                        start_time = time.time()
-                        logger.info(f"Started playing {current_file} at {start_time}")
-                    self.main_window.update_queue_display()
+                player.text_channel = ctx.channel
+                if is_playlist_url(song_title):
+                    await ctx.send(await player.enqueue_playlist(song_title, mode, ctx.author.display_name))
+                    return
+                # --stream or --download asks for YouTube, so only a plain request is looked up locally
+                track = None
+                if song_title == request:
+                    track = await asyncio.get_running_loop().run_in_executor(None, library_track, song_title, ctx.author.display_name)
+                if track is None:
+                    track = Track(None, song_title, query=song_title, mode=mode, requester=ctx.author.display_name)
+                track.requested_at = requested_at
+                position = await player.enqueue(track)
+                await ctx.send(f"Added to queue (#{position}): {track.title}")
+            except PlaylistFull:
+                await ctx.send("Queue is full.")
             except Exception as e:
                 logger.error(f"Play error: {e}")
                 await ctx.send(f"Error: {e}")
 
+        # Suggests already known songs while /play is being typed.
+        @play.autocomplete("song_title")
+        async def play_autocomplete(interaction, current):
+            return await asyncio.get_running_loop().run_in_executor(None, play_choices, current)
+
+        # Resumes prefetching when someone joins a voice channel the bot is in.
+        @bot.event
+        async def on_voice_state_update(member, before, after):
+            player = players.get(member.guild.id)
+            if player and player.is_connected() and after.channel == player.vc.channel:
+                player.kick_prefetch()
+
         # Pauses the currently playing song.
-        @bot.command(name="pause")
+        @bot.hybrid_command(name="pause", description="Pause the current song.")
+        @commands.guild_only()
         async def pause(ctx):
-            global paused_file, paused_position, start_time
-            async with vc_lock:
-                if vc and vc.is_playing():
-                    paused_file = current_file
-                    paused_position = time.time() - start_time if start_time else 0
-                    vc.pause()
-                    await ctx.send("Paused.")
+            if await get_player(ctx.guild.id).pause():
+                await ctx.send("Paused.")
+            else:
+                await ctx.send("Nothing is playing.")
 
         # Resumes a paused song.
-        @bot.command(name="resume")
+        @bot.hybrid_command(name="resume", description="Resume the paused song.")
+        @commands.guild_only()
         async def resume(ctx):
-            async with vc_lock:
-                if vc and vc.is_paused():
-                    vc.resume()
-                    await ctx.send("Resumed.")
+            if await get_player(ctx.guild.id).resume():
+                await ctx.send("Resumed.")
+            else:
+                await ctx.send("Nothing is paused.")
 
         # Stops playback and clears the queue.
-        @bot.command(name="stop")
+        @bot.hybrid_command(name="stop", description="Stop playback and clear the queue.")
+        @commands.guild_only()
         async def stop(ctx):
-            global paused_file, paused_position, current_file, start_time
-            async with vc_lock:
-                if vc and vc.is_playing():
-                    vc.stop()
-                file_queue.queue.clear()
-                paused_file, paused_position, current_file, start_time = None, 0, None, None
-                await ctx.send("Stopped and cleared.")
-            self.main_window.update_queue_display()
-            self.main_window.update_stop_button_state()
+            await ctx.defer()
+            await get_player(ctx.guild.id).stop()
+            await ctx.send("Stopped and cleared.")
 
         # Skips the current song and plays the next in the queue.
-        @bot.command(name="skip")
+        @bot.hybrid_command(name="skip", description="Skip to the next song in the queue.")
+        @commands.guild_only()
         async def skip(ctx):
-            async with vc_lock:
-                if vc and vc.is_playing():
-                    vc.stop()
-                    await ctx.send("Skipped.")
+            await ctx.defer()
+            if await get_player(ctx.guild.id).skip():
+                await ctx.send("Skipped.")
+            else:
+                await ctx.send("Nothing is playing.")
+
+        # Displays cache hit/miss counts so the resolution TTL can be tuned.
+        @bot.hybrid_command(name="cachestats", description="Show search and audio cache figures.")
+        async def cachestats(ctx):
+            stats = resolution_cache.stats()
+            await ctx.send(
+                f"Search cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), {stats['entries']} entries\n"
+                f"Audio cache: {len(audio_cache.entries)} tracks, {audio_cache.total_bytes / 1048576:.1f} MiB\n"
+                f"Music library: {len(music_library)} songs"
+            )
+
+        # Rescans the music library folders for new, changed and deleted files.
+        @bot.hybrid_command(name="rescan", description="Look for new songs in the music library folders.")
+        async def rescan(ctx):
+            if not music_library.dirs:
+                await ctx.send("No music library folders are set up (LIBRARY_DIRS).")
+                return
+            await ctx.defer()
+            count = await asyncio.wrap_future(music_library.scan())
+            await ctx.send(f"Music library has {count} songs.")
+
+        # Shows latency, cache and load figures.
+        @bot.hybrid_command(name="stats", description="Show latency, cache and load figures.")
+        async def stats(ctx):
+            lines = await asyncio.get_running_loop().run_in_executor(None, metrics.summary_lines)
+            await ctx.send("\n".join(lines))
+
+        # Shows CPU and memory use of the FFmpeg processes the bot is running.
+        @bot.hybrid_command(name="procs", description="Show the FFmpeg processes the bot is running.")
+        async def procs(ctx):
+            rows = process_supervisor.stats()
+            if not rows:
+                await ctx.send("No FFmpeg processes running.")
+                return
+            await ctx.send("FFmpeg processes:\n" + "\n".join(
+                f"{row['pid']} {row['kind']} {row['label']}: {row['cpu']:.0f}% CPU, "
+                f"{row['rss'] / 1048576:.1f} MiB (peak {row['peak_rss'] / 1048576:.1f}), {row['age']:.0f}s"
+                for row in rows
+            ))
 
         # Displays the current song queue.
-        @bot.command(name="queue")
+        @bot.hybrid_command(name="queue", description="Show the song queue.")
+        @commands.guild_only()
         async def queue(ctx):
-            if file_queue.empty():
+            player = get_player(ctx.guild.id)
+            queue_list = player.queue_items()
+            if not queue_list:
                 await ctx.send("Queue is empty.")
             else:
-                queue_list = list(file_queue.queue)
-                await ctx.send("Current queue:\n" + "\n".join(f"{i+1}. {os.path.basename(item)}" for i, item in enumerate(queue_list)))
-
-        await bot.start(TOKEN)
-
-    # Callback function to play the next song after the current one finishes.
-    def _play_next_callback(self, error):
-        if error:
-            logger.error(f"Playback error: {error}")
-        asyncio.run_coroutine_threadsafe(self.main_window.play_next(), bot.loop)
-
-# Main GUI Window
-class MainWindow(QMainWindow):
-    stop_button_signal = pyqtSignal(bool)
-
-    # Initializes the main GUI window with the bot thread.
-    def __init__(self, bot_thread):
-        super().__init__()
-        self.setWindowTitle("Discord Music Player")
-        self.setGeometry(100, 100, 600, 400)
-        self.central_widget = QWidget()
-        self.setCentralWidget(self.central_widget)
-        layout = QVBoxLayout(self.central_widget)
-
-        connection_layout = QHBoxLayout()
-        self.connect_button = QPushButton("Connect", clicked=self.connect_to_voice, enabled=False)
-        self.disconnect_button = QPushButton("Disconnect", clicked=self.disconnect_from_voice, enabled=False)
-        connection_layout.addWidget(self.connect_button)
-        connection_layout.addWidget(self.disconnect_button)
-        layout.addLayout(connection_layout)
-
-        playback_layout = QHBoxLayout()
-        self.pause_button = QPushButton("Pause", clicked=lambda: asyncio.run_coroutine_threadsafe(self.pause_music(), bot.loop))
-        self.play_button = QPushButton("Play", clicked=lambda: asyncio.run_coroutine_threadsafe(self.resume_music(), bot.loop))
-        self.stop_button = QPushButton("Stop", clicked=lambda: asyncio.run_coroutine_threadsafe(self.stop_music(), bot.loop), enabled=False)
-        self.skip_button = QPushButton("Skip", clicked=lambda: asyncio.run_coroutine_threadsafe(self.skip_to_next(), bot.loop))
-        playback_layout.addWidget(self.pause_button)
-        playback_layout.addWidget(self.play_button)
-        playback_layout.addWidget(self.stop_button)
-        playback_layout.addWidget(self.skip_button)
-        layout.addLayout(playback_layout)
-
-        volume_layout = QHBoxLayout()
-        self.music_volume_slider = QSlider(Qt.Orientation.Horizontal, minimum=0, maximum=100, value=100)
-        self.music_volume_slider.valueChanged.connect(self.update_music_volume)
-        volume_layout.addWidget(QLabel("Music Volume"))
-        volume_layout.addWidget(self.music_volume_slider)
-        layout.addLayout(volume_layout)
-
-        quick_volume_layout = QHBoxLayout()
-        self.quick_sound_volume_slider = QSlider(Qt.Orientation.Horizontal, minimum=0, maximum=100, value=100)
-        self.quick_sound_volume_slider.valueChanged.connect(self.update_quick_sound_volume)
-        quick_volume_layout.addWidget(QLabel("Quick Sound Volume"))
-        quick_volume_layout.addWidget(self.quick_sound_volume_slider)
-        layout.addLayout(quick_volume_layout)
-
-        self.pick_file_button = QPushButton("Pick File", clicked=self.pick_file)
-        layout.addWidget(self.pick_file_button)
-        self.queue_list = QListWidget()
-        layout.addWidget(self.queue_list)
-
-        quick_sound_layout = QVBoxLayout()
-        self.quick_buttons = {i: QPushButton(f"Quick Sound {i}", clicked=lambda _, i=i: self.play_quick_sound(i)) for i in range(1, 13)}
-        for button in self.quick_buttons.values():
-            quick_sound_layout.addWidget(button)
-        layout.addLayout(quick_sound_layout)
-
-        bot_thread.ready_signal.connect(self.on_bot_ready)
-        self.stop_button_signal.connect(self.stop_button.setEnabled)
-
-        quick_play_files = load_quick_play_files()
-        for i in range(1, 13):
-            if f"Quick Sound {i}" in quick_play_files:
-                self.quick_buttons[i].setText(os.path.basename(quick_play_files[f"Quick Sound {i}"]))
-
-    # Handles the bot ready signal, enabling the connect button.
-    def on_bot_ready(self, ready):
-        if ready:
-            self.connect_button.setEnabled(True)
-            logger.info("Bot ready, connect button enabled.")
-
-    # Asynchronously connects the bot to the 'tutturu~' voice channel.
-    async def connect_to_voice_async(self):
-        global vc
-        if not bot.guilds:
-            logger.error("No guilds found!")
-            return
-        voice_channel = discord.utils.get(bot.guilds[0].voice_channels, name="tutturu~")
-        if voice_channel:
-            try:
-                vc = await voice_channel.connect()
-                self.disconnect_button.setEnabled(True)
-                self.connect_button.setEnabled(False)
-                logger.info("Connected to voice channel.")
-            except discord.errors.ClientException as e:
-                logger.error(f"Connection error: {e}")
-        else:
-            logger.error("Voice channel 'tutturu~' not found!")
-
-    # Initiates an asynchronous voice connection from the GUI.
-    def connect_to_voice(self):
-        asyncio.run_coroutine_threadsafe(self.connect_to_voice_async(), bot.loop)
-
-    # Disconnects the bot from the voice channel and triggers cleanup.
-    def disconnect_from_voice(self):
-        global vc
-        if vc:
-            asyncio.run_coroutine_threadsafe(self.disconnect_and_cleanup(), bot.loop)
-            self.disconnect_button.setEnabled(False)
-            self.connect_button.setEnabled(True)
-            logger.info("Disconnected from voice channel.")
-
-    # Asynchronously disconnects from voice and cleans up temporary files.
-    async def disconnect_and_cleanup(self):
-        global vc
-        if vc:
-            if vc.is_playing() or vc.is_paused():
-                vc.stop()
-            await vc.disconnect()
-            await asyncio.sleep(1.5)
-            terminate_ffmpeg_processes()
-            if os.path.exists(TEMP_DIR):
-                logger.info("Starting temp folder cleanup...")
-                for attempt in range(3):
-                    try:
-                        shutil.rmtree(TEMP_DIR, ignore_errors=False)
-                        logger.info("Temp folder cleared successfully.")
-                        break
-                    except Exception as e:
-                        logger.warning(f"Cleanup attempt {attempt + 1} failed: {e}")
-                        if attempt < 2:
-                            await asyncio.sleep(0.5)
-                        else:
-                            logger.error(f"Failed to clear temp folder after retries: {e}")
-                os.makedirs(TEMP_DIR, exist_ok=True)
-            youtube_cache.clear()
-            logger.info("Cleanup complete.")
-            vc = None
-
-    # Pauses the currently playing music.
-    async def pause_music(self):
-        async with vc_lock:
-            if vc and vc.is_playing():
-                vc.pause()
-
-    # Resumes paused music.
-    async def resume_music(self):
-        async with vc_lock:
-            if vc and vc.is_paused():
-                vc.resume()
-
-    # Stops music playback and clears the queue.
-    async def stop_music(self):
-        global paused_file, paused_position, current_file, start_time
-        async with vc_lock:
-            if vc and vc.is_playing():
-                vc.stop()
-            file_queue.queue.clear()
-            paused_file, paused_position, current_file, start_time = None, 0, None, None
-        self.update_stop_button_state()
-        self.update_queue_display()
-
-    # Skips to the next song in the queue.
-    async def skip_to_next(self):
-        async with vc_lock:
-            if vc and vc.is_playing():
-                vc.stop()
-        self.update_stop_button_state()
-        self.update_queue_display()
-
-    # Opens a file dialog to pick an MP3 file and adds it to the queue.
-    def pick_file(self):
-        file_path, _ = QFileDialog.getOpenFileName(self, "Select File", "", "MP3 files (*.mp3);;All Files (*)")
-        if file_path:
-            file_queue.put(file_path)
-            self.update_queue_display()
-            self.update_stop_button_state()
-            if not vc or not vc.is_playing():
-                asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
-
-    # Updates the GUI queue display with current queue items.
-    @pyqtSlot()
-    def update_queue_display(self):
-        self.queue_list.clear()
-        queue_items = list(file_queue.queue)
-        for i, item in enumerate(queue_items):
-            item_display = QListWidgetItem(f"{i+1}: {os.path.basename(item)}")
-            item_display.setForeground(QColor("green") if i == 0 and vc and vc.is_playing() else QColor("orange") if i == 1 else QColor("black"))
-            self.queue_list.addItem(item_display)
-
-    # Updates the stop button's enabled state based on playback and queue status.
-    @pyqtSlot()
-    def update_stop_button_state(self):
-        self.stop_button_signal.emit(vc and (vc.is_playing() or not file_queue.empty()))
-
-    # Assigns a sound file to a quick sound button.
-    def assign_sound(self, button_index):
-        button = self.quick_buttons[button_index]
-        file_path, _ = QFileDialog.getOpenFileName(self, f"Select Sound for {button.text()}", "", "MP3 files (*.mp3);;All Files (*)")
-        if file_path:
-            button.setText(os.path.basename(file_path))
-            save_quick_play_file(f"Quick Sound {button_index}", file_path)
-
-    # Plays a quick sound, pausing current music if playing.
-    async def play_quick_sound_coroutine(self, sound_file):
-        global quick_sound_volume, is_playing_quick_sound, paused_file, paused_position, start_time
-        async with vc_lock:
-            if not vc or not vc.is_connected():
-                logger.warning("Cannot play quick sound: Bot is not connected to a voice channel.")
-                return
+                lines = [f"{i+1}. {track.summary()}" for i, track in enumerate(queue_list)]
+                if player.waiting:
+                    lines.append(f"...and {len(player.waiting)} more from playlists, joining as the queue plays.")
+                await ctx.send("Current queue:\n" + "\n".join(lines))
+
+        # Removes a song from the queue by its position.
+        @bot.hybrid_command(name="remove", description="Remove a song from the queue.")
+        @app_commands.describe(position="Position of the song in the queue")
+        @commands.guild_only()
+        async def remove(ctx, position: int):
             try:
-                if vc.is_playing() and current_file:
-                    paused_file = current_file
-                    paused_position = time.time() - start_time if start_time else 0
-                    logger.info(f"Paused at {paused_position}")
-                    vc.pause()
-                    await asyncio.sleep(0.1)
-
-                is_playing_quick_sound = True
-                source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(sound_file), volume=quick_sound_volume)
-                vc.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.resume_music_after_quick_sound(e), bot.loop))
-            except Exception as e:
-                logger.error(f"Quick sound error: {e}")
-                is_playing_quick_sound = False
-
-    # Resumes paused music after a quick sound finishes.
-    async def resume_music_after_quick_sound(self, error):
-        global is_playing_quick_sound, paused_file, paused_position, start_time, music_volume
-        async with vc_lock:
+                track = await get_player(ctx.guild.id).remove(position - 1)
+                await ctx.send(f"Removed from queue: {track.title}")
+            except IndexError:
+                await ctx.send(f"There is no song at position {position}.")
+
+        # Moves a song in the queue to a new position.
+        @bot.hybrid_command(name="move", description="Move a song to another place in the queue.")
+        @app_commands.describe(position="Position of the song in the queue", new_position="Position to move it to")
+        @commands.guild_only()
+        async def move(ctx, position: int, new_position: int):
             try:
-                is_playing_quick_sound = False
-                if error:
-                    logger.error(f"Quick sound playback error: {error}")
-                if paused_file and os.path.exists(paused_file):
-                    if not vc:
-                        await self.connect_to_voice_async()
-                    while vc.is_playing():
-                        await asyncio.sleep(0.05)
-                    source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(paused_file, before_options=f"-ss {paused_position}"), volume=music_volume)
-                    vc.play(source, after=self.after_playing)
-                    start_time = time.time() - paused_position
-                    logger.info(f"Resumed at {paused_position}")
-                else:
-                    logger.warning(f"No paused file: {paused_file}")
-            except Exception as e:
-                logger.error(f"Resume error: {e}")
-            finally:
-                paused_file, paused_position = None, 0
-
-    # Initiates playing a quick sound or prompts for assignment if none exists.
-    def play_quick_sound(self, button_index):
-        sound_file = load_quick_play_files().get(f"Quick Sound {button_index}")
-        if sound_file:
-            asyncio.run_coroutine_threadsafe(self.play_quick_sound_coroutine(sound_file), bot.loop)
-        else:
-            self.prompt_assign_sound(button_index)
+                track = await get_player(ctx.guild.id).move(position - 1, new_position - 1)
+                await ctx.send(f"Moved {track.title} to position {new_position}.")
+            except IndexError:
+                await ctx.send("Both positions must be in the queue.")
+
+        # Shuffles the queue.
+        @bot.hybrid_command(name="shuffle", description="Put the queue in random order.")
+        @commands.guild_only()
+        async def shuffle(ctx):
+            await get_player(ctx.guild.id).shuffle()
+            await ctx.send("Queue shuffled.")
+
+        # Empties the queue but lets the current song finish.
+        @bot.hybrid_command(name="clear", description="Empty the queue, keeping the current song.")
+        @commands.guild_only()
+        async def clear(ctx):
+            removed = await get_player(ctx.guild.id).clear()
+            await ctx.send(f"Removed {removed} song(s) from the queue." if removed else "Queue is already empty.")
+
+        # Suggests the queued songs for the position options of /remove and /move.
+        @remove.autocomplete("position")
+        @move.autocomplete("position")
+        @move.autocomplete("new_position")
+        async def position_autocomplete(interaction, current):
+            return queue_choices(interaction.guild_id, current)
 
-    # Prompts the user to assign a sound to a quick sound button.
-    def prompt_assign_sound(self, button_index):
-        button = self.quick_buttons[button_index]
-        if QMessageBox.question(self, "No Sound", f"No sound for {button.text()}. Assign now?",
-                                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No) == QMessageBox.StandardButton.Yes:
-            self.assign_sound(button_index)
-
-    # Plays the next song in the queue if available.
-    async def play_next(self):
-        global current_file, start_time, music_volume
-        async with vc_lock:
-            if vc and not file_queue.empty():
-                current_file = file_queue.get()
-                if os.path.exists(current_file):
-                    source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(current_file), volume=music_volume)
-                    if not vc.is_playing():
-                        vc.play(source, after=self.after_playing)
-                        start_time = time.time()
-                        logger.info(f"Started playing {current_file} at {start_time}")
-                else:
-                    logger.error(f"File missing: {current_file}")
-            else:
-                logger.info("Queue empty.")
-                start_time = None
-        self.update_stop_button_state()
-        self.update_queue_display()
-
-    # Callback function to handle the end of playback and trigger the next song.
-    def after_playing(self, error):
-        if error:
-            logger.error(f"Playback error: {error}")
-        if not is_playing_quick_sound:
-            asyncio.run_coroutine_threadsafe(self.play_next(), bot.loop)
+        await bot.start(TOKEN)
 
-    # Updates the music volume based on the slider value.
-    def update_music_volume(self):
-        global music_volume
-        music_volume = self.music_volume_slider.value() / 100
-        asyncio.run_coroutine_threadsafe(self.set_music_volume(music_volume), bot.loop)
-
-    # Updates the quick sound volume based on the slider value.
-    def update_quick_sound_volume(self):
-        global quick_sound_volume
-        quick_sound_volume = self.quick_sound_volume_slider.value() / 100
-
-    # Sets the music volume asynchronously.
-    async def set_music_volume(self, new_volume):
-        async with vc_lock:
-            if vc and vc.source:
-                vc.source.volume = new_volume
-
-    # Handles window close events by cleaning up temporary files.
-    def closeEvent(self, event):
-        if os.path.exists(TEMP_DIR):
-            terminate_ffmpeg_processes()
-            shutil.rmtree(TEMP_DIR, ignore_errors=True)
-        event.accept()
+# Closes the bot and cleans up its processes and temp files on the way out.
+def shutdown(bot_thread=None):
+    if bot_thread and bot_thread.is_alive() and control_api.loop:
+        try:
+            asyncio.run_coroutine_threadsafe(close_bot(), control_api.loop).result(5)
+        except Exception as e:
+            logger.warning(f"Bot did not close cleanly: {e}")
+    control_api.stop()
+    audio_cache.flush()
+    audio_workers.shutdown()
+    loudness_executor.shutdown(wait=False, cancel_futures=True)
+    music_library.shutdown()
+    process_supervisor.reap()
+    janitor.shutdown()
+
+# Parses the command line.
+def parse_args():
+    parser = argparse.ArgumentParser(description="Discord music bot with YouTube playback.")
+    parser.add_argument("--headless", action="store_true", help="run only the bot and its control API, without the window")
+    parser.add_argument("--port", type=int,
+                        help=f"control API port (default {CONTROL_PORT} with --headless, any free port with the window)")
+    parser.add_argument("--audio-workers", type=int, default=AUDIO_WORKERS,
+                        help="processes to decode, mix and encode audio in; 0 does it in the bot process")
+    parser.add_argument("--gateway", choices=("full", "minimal"), default=GATEWAY_PROFILE,
+                        help="events to receive from Discord; minimal serves slash commands only")
+    return parser.parse_args()
 
 # Main entry point to initialize and run the application.
 def main():
-    import sys
-    if os.path.exists(TEMP_DIR):
-        logger.info("Cleaning up temp folder on startup...")
-        terminate_ffmpeg_processes()
+    global bot
+    args = parse_args()
+    if args.gateway != GATEWAY_PROFILE:
+        bot = create_bot(args.gateway)
+    janitor.start()
+    audio_cache.load()
+    resolution_cache.load()
+    soundboard.load()
+    music_library.load()
+    music_library.scan()
+    for video_id in audio_cache.unmeasured():
+        schedule_loudness_analysis(video_id)
+    start_metrics_server()
+    control_api.port = args.port if args.port is not None else CONTROL_PORT if args.headless else 0
+    if not args.headless and not control_api.token:
+        control_api.token = secrets.token_urlsafe(32)
+    audio_workers.size = max(0, args.audio_workers)
+    audio_workers.start()
+    if not control_api.start():
+        sys.exit(1)
+
+    if args.headless:
         try:
-            shutil.rmtree(TEMP_DIR, ignore_errors=False)
-            logger.info("Temp folder cleared on startup.")
-        except Exception as e:
-            logger.error(f"Failed to clear temp folder on startup: {e}")
-        os.makedirs(TEMP_DIR, exist_ok=True)
+            BotThread().run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutdown()
+        return
 
-    app = QApplication(sys.argv)
+    try:
+        control_panel = importlib.import_module("control_panel")
+    except ImportError as e:
+        logger.error(f"Cannot open the window ({e}). Install PyQt6 or run with --headless.")
+        shutdown()
+        sys.exit(1)
     bot_thread = BotThread()
-    main_window = MainWindow(bot_thread)
-    bot_thread.main_window = main_window
     bot_thread.start()
-    main_window.show()
-    sys.exit(app.exec())
+    try:
+        exit_code = control_panel.run(f"http://{CONTROL_HOST}:{control_api.port}", control_api.token)
+    finally:
+        shutdown(bot_thread)
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,63 @@
+import signal
+import audioop
+import discord
+
+# Audio worker process for the music bot. The bot's mixer sends it the raw layers of each 20ms
+# frame (Opus packets or PCM, each with a volume) and it decodes, scales, sums and encodes them,
+# answering with one Opus packet, so none of that work runs in the bot's own interpreter.
+# Started by the bot when AUDIO_WORKERS is set, not meant to be run directly.
+
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+SAMPLES_PER_FRAME = discord.opus.Encoder.SAMPLES_PER_FRAME
+
+# Holds the Opus encoder of one voice stream and the decoders of the Opus layers mixed into it.
+class Stream:
+    # Initializes a stream with its own encoder, so consecutive frames are encoded as one signal.
+    def __init__(self):
+        self.encoder = discord.opus.Encoder()
+        self.decoders = {}
+
+    # Mixes one frame's layers, given as (key, data, is_opus, volume), and returns it as an Opus packet.
+    # Packets that are not audio, like Ogg headers, are mixed as silence. The bot caps the volumes.
+    def encode(self, layers):
+        frame = None
+        for key, data, is_opus, volume in layers:
+            if is_opus:
+                decoder = self.decoders.get(key)
+                if decoder is None:
+                    decoder = self.decoders[key] = discord.opus.Decoder()
+                try:
+                    data = decoder.decode(data)[:FRAME_SIZE]
+                except discord.opus.OpusError:
+                    data = bytes(FRAME_SIZE)
+            if len(data) < FRAME_SIZE:
+                data += bytes(FRAME_SIZE - len(data))
+            if volume != 1.0:
+                data = audioop.mul(data, 2, volume)
+            frame = data if frame is None else audioop.add(frame, data, 2)
+        return self.encoder.encode(frame or bytes(FRAME_SIZE), SAMPLES_PER_FRAME)
+
+# Serves the bot over conn until it closes the pipe. Messages are ("frame", stream, layers), answered
+# with the packet or None if encoding failed, ("forget", stream, key) and ("close", stream).
+def run(conn):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    streams = {}
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        kind, stream_id = message[0], message[1]
+        if kind == "frame":
+            try:
+                stream = streams.get(stream_id)
+                if stream is None:
+                    stream = streams[stream_id] = Stream()
+                packet = stream.encode(message[2])
+            except Exception:
+                packet = None
+            conn.send_bytes(packet or b"")
+        elif kind == "forget" and stream_id in streams:
+            streams[stream_id].decoders.pop(message[2], None)
+        elif kind == "close":
+            streams.pop(stream_id, None)
@@ -0,0 +1,501 @@
+import os
+import sys
+import time
+import json
+import shutil
+import asyncio
+import audioop
+import argparse
+import tempfile
+import threading
+import subprocess
+import importlib.util
+import psutil
+from types import SimpleNamespace
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+# Offline benchmark for the music bot. Runs scripted play/skip/quick sound sessions against a stand-in
+# YouTube (local fixture audio with configurable latency) and a stand-in voice client that pulls frames
+# in real time like discord.py's AudioPlayer, then reports time to first audio, gaps, late frames,
+# FFmpeg CPU and cache behaviour. Needs FFmpeg on the PATH but no network or Discord connection.
+#
+#   python benchmark.py
+#   python benchmark.py --scenarios cold-stream,warm --track-seconds 10 --json results.json
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DiscordBot+YoutubePlayer.py")
+FRAME_DELAY = 0.02
+LATE_FRAME_TOLERANCE = 0.06  # Frames later than this would miss the listener's jitter buffer
+SILENCE_THRESHOLD = 16
+SAMPLE_INTERVAL = 0.5
+OPUS_SILENCE = b'\xf8\xff\xfe'
+IDLE_TIMEOUT = 120
+SCENARIOS = ("cold-stream", "cold-download", "warm", "skip-and-sounds", "load")
+
+# Loads the bot script as a module without starting the bot or the window.
+def load_bot():
+    spec = importlib.util.spec_from_file_location("musicbot", BOT_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Renders a tone of the given length to a file with FFmpeg.
+def make_fixture(path, seconds, frequency=440):
+    args = ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'lavfi', '-i', f"sine=frequency={frequency}:duration={seconds}",
+            '-ac', '2', '-ar', '48000', path]
+    subprocess.run(args, check=True, stdin=subprocess.DEVNULL)
+    return path
+
+# Returns True if discord.py can load libopus, which mixing quick sounds over Opus music needs.
+def opus_available(bot):
+    try:
+        if not bot.discord.opus.is_loaded():
+            bot.discord.opus._load_default()
+        return bot.discord.opus.is_loaded()
+    except Exception:
+        return False
+
+# Fake YouTube
+class FakeCatalog:
+    # Initializes a catalog that maps every query to a fixture-backed video and counts what was asked of it.
+    def __init__(self, fixtures, stream_base_url, track_seconds, search_latency, download_latency, transcode_latency):
+        self.fixtures = fixtures
+        self.stream_base_url = stream_base_url
+        self.track_seconds = track_seconds
+        self.search_latency = search_latency
+        self.download_latency = download_latency
+        self.transcode_latency = transcode_latency
+        self.ids = {}
+        self.searches = 0
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    # Returns the video info for a query or watch URL, assigning a new video ID to queries it has not seen.
+    def video(self, query):
+        if "watch?v=" in query:
+            video_id = query.split("watch?v=", 1)[1].split("&", 1)[0]
+        else:
+            with self.lock:
+                video_id = self.ids.setdefault(query.strip().casefold(), f"bench{len(self.ids):04d}")
+        return {
+            'id': video_id,
+            'title': f"Bench song {video_id}",
+            'duration': self.track_seconds,
+            'url': f"{self.stream_base_url}/stream.opus?expire={int(time.time()) + 6 * 3600}",
+            'acodec': "opus",
+        }
+
+class FakeYoutubeDL:
+    catalog = None
+
+    # Initializes the stand-in with the options the bot passes to YoutubeDL.
+    def __init__(self, opts):
+        self.opts = opts
+
+    # Enters the context manager.
+    def __enter__(self):
+        return self
+
+    # Leaves the context manager.
+    def __exit__(self, *exc):
+        return False
+
+    # Answers searches, video lookups and flat playlist listings after the configured search latency.
+    def extract_info(self, query, download=False):
+        catalog = self.catalog
+        time.sleep(catalog.search_latency)
+        with catalog.lock:
+            catalog.searches += 1
+        if self.opts.get('extract_flat'):
+            entries = [catalog.video(f"{query} #{i}") for i in range(self.opts.get('playlistend') or 10)]
+            return {'title': "Bench playlist", 'entries': iter(entries)}
+        info = catalog.video(query)
+        if query.startswith(("http://", "https://")):
+            return info
+        return {'entries': [info]}
+
+    # "Downloads" a video by copying the fixture in the requested format after the configured latency,
+    # calling yt-dlp's progress and post-processor hooks the way the real download does.
+    def download(self, urls):
+        catalog = self.catalog
+        codec = self.opts['postprocessors'][0]['preferredcodec']
+        for url in urls:
+            info = catalog.video(url)
+            deadline = time.monotonic() + catalog.download_latency
+            while time.monotonic() < deadline:
+                for hook in self.opts.get('progress_hooks', []):
+                    hook({'status': "downloading", 'info_dict': info})
+                time.sleep(min(0.05, max(0, deadline - time.monotonic())))
+            for hook in self.opts.get('progress_hooks', []):
+                hook({'status': "finished", 'info_dict': info})
+            for hook in self.opts.get('postprocessor_hooks', []):
+                hook({'status': "started", 'postprocessor': "ExtractAudio", 'info_dict': info})
+            time.sleep(catalog.transcode_latency)
+            shutil.copy(catalog.fixtures[codec], f"{self.opts['outtmpl']}.{codec}")
+            for hook in self.opts.get('postprocessor_hooks', []):
+                hook({'status': "finished", 'postprocessor': "ExtractAudio", 'info_dict': info})
+            with catalog.lock:
+                catalog.downloads += 1
+        return 0
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    # Keeps fixture requests out of the report.
+    def log_message(self, format, *args):
+        pass
+
+# Serves the stream fixture over HTTP so streamed songs go through FFmpeg's network input like real ones.
+def start_stream_server(directory):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Fake Voice
+class FakeMember:
+    bot = False
+
+class FakeChannel:
+    name = "benchmark"
+    members = [FakeMember()]
+
+class FakeVoiceClient:
+    # Initializes a voice client that plays sources on a thread paced at one frame per 20ms.
+    # Given an Opus encoder it encodes PCM frames the way discord.py does before sending them.
+    def __init__(self, encoder=None):
+        self.channel = FakeChannel()
+        self.encoder = encoder
+        self.audio_times = []
+        self.silent_frames = 0
+        self.late_frames = 0
+        self.frames = 0
+        self._run = None
+        self._end = None
+
+    # Returns True while connected, which is always.
+    def is_connected(self):
+        return True
+
+    # Returns True while a source is playing and not paused.
+    def is_playing(self):
+        return self._end is not None and not self._end.is_set() and self._run.is_set()
+
+    # Returns True while a source is paused.
+    def is_paused(self):
+        return self._end is not None and not self._end.is_set() and not self._run.is_set()
+
+    # Starts pulling frames from a source on a new thread, calling after when it ends.
+    def play(self, source, after=None):
+        if self.is_playing() or self.is_paused():
+            raise RuntimeError("Already playing audio.")
+        run, end = threading.Event(), threading.Event()
+        run.set()
+        self._run, self._end = run, end
+        threading.Thread(target=self._play, args=(source, after, run, end), daemon=True).start()
+
+    # Reads frames on schedule, recording when audio went out and how late each frame was.
+    def _play(self, source, after, run, end):
+        error = None
+        start, loops = time.perf_counter(), 0
+        try:
+            while not end.is_set():
+                if not run.is_set():
+                    run.wait()
+                    start, loops = time.perf_counter(), 0
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                self.frames += 1
+                if len(data) > len(OPUS_SILENCE) if source.is_opus() else audioop.max(data, 2) > SILENCE_THRESHOLD:
+                    self.audio_times.append(now)
+                else:
+                    self.silent_frames += 1
+                if self.encoder and not source.is_opus():
+                    self.encoder.encode(data, self.encoder.SAMPLES_PER_FRAME)
+                if now - (start + FRAME_DELAY * loops) > LATE_FRAME_TOLERANCE:
+                    self.late_frames += 1
+                    start, loops = now, 0
+                loops += 1
+                time.sleep(max(0, start + FRAME_DELAY * loops - time.perf_counter()))
+        except Exception as e:
+            error = e
+        end.set()
+        source.cleanup()
+        if after:
+            after(error)
+
+    # Stops the current source.
+    def stop(self):
+        if self._end is not None:
+            self._end.set()
+            self._run.set()
+
+    # Pauses the current source.
+    def pause(self):
+        if self._run is not None:
+            self._run.clear()
+
+    # Resumes the current source.
+    def resume(self):
+        if self._run is not None:
+            self._run.set()
+
+    # Disconnects, which just stops playback.
+    async def disconnect(self):
+        self.stop()
+
+# Driver
+class Benchmark:
+    # Initializes a run against the loaded bot module with the stand-ins installed.
+    def __init__(self, bot, catalog, args, opus=False):
+        self.bot = bot
+        self.catalog = catalog
+        self.args = args
+        self.opus = opus
+        self.next_guild = 1
+
+    # Creates a player for a new guild wired to a fake voice client.
+    def new_player(self):
+        player = self.bot.get_player(self.next_guild)
+        self.next_guild += 1
+        player.vc = FakeVoiceClient(self.bot.discord.opus.Encoder() if self.opus else None)
+        return player
+
+    # Queues a song the way !play does.
+    async def play(self, player, query, mode="stream"):
+        await player.enqueue(self.bot.Track(None, query, query=query, mode=mode, requester="benchmark"))
+
+    # Waits until the player has nothing playing or queued.
+    async def wait_idle(self, player):
+        deadline = time.monotonic() + IDLE_TIMEOUT
+        while time.monotonic() < deadline:
+            if player.current_track is None and len(player.playlist) == 0 and not player.music_active():
+                return
+            await asyncio.sleep(0.1)
+        raise TimeoutError(f"Guild {player.guild_id} did not finish within {IDLE_TIMEOUT}s")
+
+    # Samples FFmpeg, audio worker and bot CPU use until stopped.
+    async def sample_cpu(self, samples, stop):
+        own = psutil.Process()
+        workers = [psutil.Process(worker.process.pid) for worker in self.bot.audio_workers.workers]
+        for process in [own] + workers:
+            process.cpu_percent(None)
+        while not stop.is_set():
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            rows = await asyncio.get_running_loop().run_in_executor(None, self.bot.process_supervisor.stats, 0)
+            streams = [row['cpu'] for row in rows if row['owner'] is not None]
+            worker_cpu = 0.0
+            for process in workers:
+                try:
+                    worker_cpu += process.cpu_percent(None)
+                except psutil.Error:
+                    pass
+            samples.append({'bot': own.cpu_percent(None), 'workers': worker_cpu, 'streams': streams})
+
+    # Runs one scenario and returns its measurements.
+    async def run(self, name):
+        metrics = self.bot.metrics
+        before = self.snapshot()
+        stop, samples = asyncio.Event(), []
+        sampler = asyncio.create_task(self.sample_cpu(samples, stop))
+        players = await getattr(self, "scenario_" + name.replace("-", "_"))()
+        stop.set()
+        await sampler
+        after = self.snapshot()
+
+        gaps, late, silent, frames = [], 0, 0, 0
+        for player in players:
+            times = player.vc.audio_times
+            gaps += [b - a - FRAME_DELAY for a, b in zip(times, times[1:]) if b - a > FRAME_DELAY * 1.5]
+            late += player.vc.late_frames
+            silent += player.vc.silent_frames
+            frames += player.vc.frames
+        new_ttfa = after['ttfa_count'] - before['ttfa_count']
+        ttfa = sorted(list(metrics.histograms['time_to_first_audio_seconds'].recent)[-new_ttfa:]) if new_ttfa else []
+        stream_cpu = [cpu for sample in samples for cpu in sample['streams']]
+        return {
+            'scenario': name,
+            'time_to_first_audio_ms': [round(value * 1000) for value in ttfa],
+            'gaps': len(gaps),
+            'gap_max_ms': round(max(gaps) * 1000) if gaps else 0,
+            'gap_total_ms': round(sum(gaps) * 1000),
+            'frames': frames,
+            'silent_frames': silent,
+            'late_frames': late,
+            'stream_cpu_percent': round(sum(stream_cpu) / len(stream_cpu), 1) if stream_cpu else 0.0,
+            'bot_cpu_percent': round(sum(s['bot'] for s in samples) / len(samples), 1) if samples else 0.0,
+            'worker_cpu_percent': round(sum(s['workers'] for s in samples) / len(samples), 1) if samples else 0.0,
+            'searches': after['searches'] - before['searches'],
+            'downloads': after['downloads'] - before['downloads'],
+            'cache': {key: after['cache'][key] - before['cache'].get(key, 0) for key in after['cache']},
+        }
+
+    # Returns the counters a scenario is measured against.
+    def snapshot(self):
+        metrics = self.bot.metrics
+        histogram = metrics.histograms.get('time_to_first_audio_seconds')
+        cache = {}
+        for layer in ("resolution", "audio", "soundboard"):
+            for result in ("hit", "miss"):
+                cache[f"{layer}_{result}"] = metrics.counter('cache_lookups_total', {'layer': layer, 'result': result})
+        return {
+            'ttfa_count': histogram.count if histogram else 0,
+            'searches': self.catalog.searches,
+            'downloads': self.catalog.downloads,
+            'cache': cache,
+        }
+
+    # Three new songs streamed back to back.
+    async def scenario_cold_stream(self):
+        player = self.new_player()
+        for i in range(3):
+            await self.play(player, f"cold stream song {i}")
+        await self.wait_idle(player)
+        return [player]
+
+    # Three new songs that have to download before they play.
+    async def scenario_cold_download(self):
+        player = self.new_player()
+        for i in range(3):
+            await self.play(player, f"cold download song {i}", mode="download")
+        await self.wait_idle(player)
+        return [player]
+
+    # The cold-stream songs again, which should now come from the caches.
+    async def scenario_warm(self):
+        player = self.new_player()
+        for i in range(3):
+            await self.play(player, f"cold stream song {i}")
+        await self.wait_idle(player)
+        return [player]
+
+    # Skips part-way through songs while quick sounds play over the music.
+    async def scenario_skip_and_sounds(self):
+        player = self.new_player()
+        for i in range(4):
+            await self.play(player, f"skip song {i}")
+        for _ in range(2):
+            for _ in range(3):
+                await asyncio.sleep(0.7)
+                await player.play_quick_sound("Quick Sound 1")
+            await player.skip()
+        await self.wait_idle(player)
+        return [player]
+
+    # Several guilds streaming at once.
+    async def scenario_load(self):
+        players = [self.new_player() for _ in range(self.args.guilds)]
+        for index, player in enumerate(players):
+            for i in range(2):
+                await self.play(player, f"load guild {index} song {i}")
+        await asyncio.gather(*(self.wait_idle(player) for player in players))
+        return players
+
+# Prints one scenario's results as a short block.
+def print_result(result):
+    ttfa = result['time_to_first_audio_ms']
+    print(f"== {result['scenario']}")
+    print(f"  time to first audio: {', '.join(f'{value} ms' for value in ttfa) or 'n/a'}")
+    print(f"  gaps: {result['gaps']} (max {result['gap_max_ms']} ms, total {result['gap_total_ms']} ms), "
+          f"silent frames: {result['silent_frames']}, late frames: {result['late_frames']} of {result['frames']}")
+    print(f"  CPU: {result['stream_cpu_percent']}% per FFmpeg stream, {result['bot_cpu_percent']}% bot, "
+          f"{result['worker_cpu_percent']}% audio workers")
+    cache = result['cache']
+    print(f"  YouTube: {result['searches']} lookups, {result['downloads']} downloads; cache hits/misses: "
+          + ", ".join(f"{layer} {cache[layer + '_hit']}/{cache[layer + '_miss']}" for layer in ("resolution", "audio", "soundboard")))
+
+# Runs the chosen scenarios in order and prints each one's results.
+async def run_benchmark(args, bot, opus=False):
+    bot.bot.loop = asyncio.get_running_loop()
+    results = []
+    benchmark = Benchmark(bot, FakeYoutubeDL.catalog, args, opus)
+    for name in args.scenarios:
+        result = await benchmark.run(name)
+        print_result(result)
+        results.append(result)
+    for player in list(bot.players.values()):
+        await player.disconnect()
+    return results
+
+# Parses the command line.
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Discord music bot.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--track-seconds", type=float, default=6, help="length of every fixture song")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="seconds each fake YouTube lookup takes")
+    parser.add_argument("--download-latency", type=float, default=1.0, help="seconds each fake download takes")
+    parser.add_argument("--transcode-latency", type=float, default=0.1, help="seconds each fake post-processing step takes")
+    parser.add_argument("--guilds", type=int, default=4, help="guilds streaming at once in the load scenario")
+    parser.add_argument("--audio-workers", type=int, default=0, help="run the bot's audio in this many worker processes (needs libopus)")
+    parser.add_argument("--no-passthrough", action="store_true", help="decode Opus songs to PCM so every frame is mixed and encoded")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    return args
+
+# Entry point.
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix="musicbot-bench-")
+    stream_server = None
+    try:
+        fixtures_dir = os.path.join(work_dir, "fixtures")
+        os.makedirs(fixtures_dir)
+        fixtures = {
+            'opus': make_fixture(os.path.join(fixtures_dir, "song.opus"), args.track_seconds),
+            'mp3': make_fixture(os.path.join(fixtures_dir, "song.mp3"), args.track_seconds),
+        }
+        shutil.copy(fixtures['opus'], os.path.join(fixtures_dir, "stream.opus"))
+        quick_sound = make_fixture(os.path.join(fixtures_dir, "quick.mp3"), 0.5, frequency=880)
+        stream_server = start_stream_server(fixtures_dir)
+
+        bot = load_bot()
+        FakeYoutubeDL.catalog = FakeCatalog(fixtures, f"http://127.0.0.1:{stream_server.server_address[1]}",
+                                            args.track_seconds, args.search_latency, args.download_latency,
+                                            args.transcode_latency)
+        bot.yt_dlp = SimpleNamespace(YoutubeDL=FakeYoutubeDL, utils=bot.yt_dlp.utils)
+        bot.TEMP_DIR = os.path.join(work_dir, "temp")
+        bot.janitor.temp_dir = bot.TEMP_DIR
+        bot.janitor.start().result()
+        bot.audio_cache.__init__(os.path.join(work_dir, "cache"), bot.CACHE_MAX_BYTES, bot.CACHE_EVICTION_POLICY)
+        bot.audio_cache.load()
+        bot.resolution_cache.path = None
+        bot.soundboard.assignments = {"Quick Sound 1": quick_sound}
+        opus = opus_available(bot)
+        if not opus:
+            print("libopus not found: Opus songs are decoded to PCM instead of passed through, and PCM is not encoded.")
+            if args.audio_workers:
+                print("Audio workers need libopus, running without them.")
+                args.audio_workers = 0
+        if args.no_passthrough or not opus:
+            bot.OPUS_PASSTHROUGH = False
+        bot.audio_workers.size = args.audio_workers
+        bot.audio_workers.start()
+        for worker in bot.audio_workers.workers:
+            # The bot starts its workers at launch; wait for them here so start-up is not measured.
+            stream_id = worker.open()
+            worker.encode(stream_id, [])
+            worker.close(stream_id)
+
+        results = asyncio.run(run_benchmark(args, bot, opus))
+        if args.json:
+            with open(args.json, "w", encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        bot.loudness_executor.shutdown(wait=False, cancel_futures=True)
+        bot.process_supervisor.reap()
+        bot.audio_workers.shutdown()
+        bot.janitor.shutdown()
+    finally:
+        if stream_server:
+            stream_server.shutdown()
+        if args.keep:
+            print(f"Scratch directory kept at {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    sys.exit(main())
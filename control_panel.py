@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from urllib.parse import quote
+from PyQt6.QtWidgets import QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QListView, QStyledItemDelegate, QFileDialog, QMessageBox, QSlider, QLabel, QComboBox
+from PyQt6.QtCore import QObject, QTimer, QUrl, Qt, QAbstractListModel, QModelIndex, pyqtSignal, pyqtSlot
+from PyQt6.QtGui import QColor
+from PyQt6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply
+
+# Window for the music bot. It only talks to the bot's control API, so it is opened by the bot
+# itself or can be pointed at a bot running headless on the same machine:
+#
+#   python control_panel.py --url http://127.0.0.1:8765
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = "http://127.0.0.1:8765"
+QUICK_SOUND_COUNT = 12
+STATS_REFRESH_MS = 2000
+RETRY_DELAY_MS = 1000
+POLL_TIMEOUT_MS = 35000  # A little longer than the bot holds a GET /state?since=N
+REQUEST_TIMEOUT_MS = 35000
+REFRESH_INTERVAL_MS = 33  # The window shows at most one new state per interval, bursts in between are merged
+
+# Control API Client
+class ControlClient(QObject):
+    state_changed = pyqtSignal(dict)
+    stats_changed = pyqtSignal(list)
+    error = pyqtSignal(str)
+
+    # Initializes a client for the control API at url.
+    def __init__(self, url, token=None, parent=None):
+        super().__init__(parent)
+        self.url = url.rstrip("/")
+        self.token = token
+        self.version = -1
+        self.reachable = None
+        self.network = QNetworkAccessManager(self)
+
+    # Builds a request for an API path.
+    def request(self, path, timeout=REQUEST_TIMEOUT_MS):
+        request = QNetworkRequest(QUrl(self.url + path))
+        request.setHeader(QNetworkRequest.KnownHeaders.ContentTypeHeader, "application/json")
+        request.setTransferTimeout(timeout)
+        if self.token:
+            request.setRawHeader(b"Authorization", f"Bearer {self.token}".encode())
+        return request
+
+    # Sends a request without blocking. on_done gets the decoded answer, or None if the request failed;
+    # quiet leaves a failure unreported.
+    def send(self, method, path, body=None, on_done=None, timeout=REQUEST_TIMEOUT_MS, quiet=False):
+        if method == "GET":
+            reply = self.network.get(self.request(path, timeout))
+        else:
+            reply = self.network.sendCustomRequest(self.request(path, timeout), method.encode(), json.dumps(body or {}).encode())
+        reply.finished.connect(lambda: self._finished(reply, on_done, quiet))
+
+    # Decodes a finished reply and hands it on, reporting API errors.
+    def _finished(self, reply, on_done, quiet):
+        reply.deleteLater()
+        try:
+            answer = json.loads(bytes(reply.readAll()) or b"{}")
+        except ValueError:
+            answer = {}
+        if reply.error() != QNetworkReply.NetworkError.NoError:
+            message = answer.get('error') if isinstance(answer, dict) and answer.get('error') else reply.errorString()
+            if not quiet:
+                logger.warning(f"Control API: {message}")
+                self.error.emit(message)
+            answer = None
+        if on_done:
+            on_done(answer)
+
+    # Asks for the next state change; the bot holds the request until something changes.
+    # Only the first of a run of failed polls is reported.
+    def poll(self):
+        self.send("GET", f"/state?since={self.version}", on_done=self._polled, timeout=POLL_TIMEOUT_MS, quiet=self.reachable is False)
+
+    # Publishes a new state and polls again, retrying after a pause while the bot is unreachable.
+    def _polled(self, state):
+        self.reachable = state is not None
+        if state is None:
+            QTimer.singleShot(RETRY_DELAY_MS, self.poll)
+            return
+        if state['version'] != self.version or not state['ready']:
+            self.version = state['version']
+            self.state_changed.emit(state)
+        self.poll()
+
+    # Fetches the metrics summary.
+    def refresh_stats(self):
+        self.send("GET", "/stats", on_done=lambda answer: answer and self.stats_changed.emit(answer['lines']))
+
+    # Runs a player control for a guild.
+    def guild_action(self, guild_id, action, body=None):
+        self.send("POST", f"/guilds/{guild_id}/{action}", body)
+
+    # Sets the music and/or quick sound volume (0-1).
+    def set_volume(self, music=None, quick_sound=None):
+        self.send("POST", "/volume", {'music': music, 'quick_sound': quick_sound})
+
+    # Assigns a file to a quick sound.
+    def assign_sound(self, name, file_path):
+        self.send("PUT", f"/quick-sounds/{quote(name)}", {'path': file_path})
+
+# Queue Model
+class QueueModel(QAbstractListModel):
+    # Initializes an empty queue. Rows are the API's queue entries, {"id": ..., "summary": ...}.
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.playing = False
+
+    # Returns the number of queued songs.
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    # Returns a row's summary, coloured green for the playing song and orange for the next one.
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.rows):
+            return None
+        row = index.row()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return self.rows[row]['summary']
+        if role == Qt.ItemDataRole.ForegroundRole:
+            return QColor("green") if row == 0 and self.playing else QColor("orange") if row == 1 else QColor("black")
+        return None
+
+    # Replaces every row, e.g. when another server is selected.
+    def reset(self, queue, playing):
+        self.beginResetModel()
+        self.rows = [dict(entry) for entry in queue]
+        self.playing = playing
+        self.endResetModel()
+
+    # Brings the rows in line with a new queue one removal, move, insertion or changed row at a time,
+    # so the view only updates the rows that actually changed.
+    def update(self, queue, playing):
+        wanted = {entry['id'] for entry in queue}
+        row = len(self.rows) - 1
+        while row >= 0:
+            if self.rows[row]['id'] in wanted:
+                row -= 1
+                continue
+            last = row
+            while row > 0 and self.rows[row - 1]['id'] not in wanted:
+                row -= 1
+            self.beginRemoveRows(QModelIndex(), row, last)
+            del self.rows[row:last + 1]
+            self.endRemoveRows()
+            row -= 1
+
+        present = {entry['id'] for entry in self.rows}
+        kept = [entry['id'] for entry in queue if entry['id'] in present]
+        if sum(a != b['id'] for a, b in zip(kept, self.rows)) > len(self.rows) // 2:
+            # Mostly reordered, e.g. shuffled: one reset is cheaper than a move per row.
+            self.reset(queue, playing)
+            return
+        target = 0
+        while target < len(queue):
+            entry = queue[target]
+            if entry['id'] not in present:
+                end = target
+                while end + 1 < len(queue) and queue[end + 1]['id'] not in present:
+                    end += 1
+                self.beginInsertRows(QModelIndex(), target, end)
+                self.rows[target:target] = [dict(new) for new in queue[target:end + 1]]
+                self.endInsertRows()
+                target = end + 1
+                continue
+            if self.rows[target]['id'] != entry['id']:
+                source = next(i for i in range(target + 1, len(self.rows)) if self.rows[i]['id'] == entry['id'])
+                self.beginMoveRows(QModelIndex(), source, source, QModelIndex(), target)
+                self.rows.insert(target, self.rows.pop(source))
+                self.endMoveRows()
+            if self.rows[target]['summary'] != entry['summary']:
+                self.rows[target] = dict(entry)
+                self.dataChanged.emit(self.index(target), self.index(target))
+            target += 1
+
+        self.playing = playing
+        if self.rows:
+            self.dataChanged.emit(self.index(0), self.index(min(1, len(self.rows) - 1)), [Qt.ItemDataRole.ForegroundRole])
+
+class QueueDelegate(QStyledItemDelegate):
+    # Numbers the rows as they are painted, so moving a song does not change every row's data.
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        option.text = f"{index.row()+1}: {option.text}"
+
+# Main GUI Window
+class MainWindow(QMainWindow):
+    # Initializes the main GUI window around a control API client.
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.state = {'ready': False, 'guilds': [], 'quick_sounds': {}}
+        self.setWindowTitle("Discord Music Player")
+        self.setGeometry(100, 100, 600, 400)
+        self.central_widget = QWidget()
+        self.setCentralWidget(self.central_widget)
+        layout = QVBoxLayout(self.central_widget)
+        self.guild_id = None
+
+        guild_layout = QHBoxLayout()
+        self.guild_combo = QComboBox()
+        self.guild_combo.currentIndexChanged.connect(self.select_guild)
+        guild_layout.addWidget(QLabel("Server"))
+        guild_layout.addWidget(self.guild_combo)
+        layout.addLayout(guild_layout)
+
+        connection_layout = QHBoxLayout()
+        self.connect_button = QPushButton("Connect", clicked=lambda: self.run_on_player("connect"), enabled=False)
+        self.disconnect_button = QPushButton("Disconnect", clicked=lambda: self.run_on_player("disconnect"), enabled=False)
+        connection_layout.addWidget(self.connect_button)
+        connection_layout.addWidget(self.disconnect_button)
+        layout.addLayout(connection_layout)
+
+        playback_layout = QHBoxLayout()
+        self.pause_button = QPushButton("Pause", clicked=lambda: self.run_on_player("pause"))
+        self.play_button = QPushButton("Play", clicked=lambda: self.run_on_player("resume"))
+        self.stop_button = QPushButton("Stop", clicked=lambda: self.run_on_player("stop"), enabled=False)
+        self.skip_button = QPushButton("Skip", clicked=lambda: self.run_on_player("skip"))
+        playback_layout.addWidget(self.pause_button)
+        playback_layout.addWidget(self.play_button)
+        playback_layout.addWidget(self.stop_button)
+        playback_layout.addWidget(self.skip_button)
+        layout.addLayout(playback_layout)
+
+        volume_layout = QHBoxLayout()
+        self.music_volume_slider = QSlider(Qt.Orientation.Horizontal, minimum=0, maximum=100, value=100)
+        self.music_volume_slider.valueChanged.connect(lambda value: self.client.set_volume(music=value / 100))
+        volume_layout.addWidget(QLabel("Music Volume"))
+        volume_layout.addWidget(self.music_volume_slider)
+        layout.addLayout(volume_layout)
+
+        quick_volume_layout = QHBoxLayout()
+        self.quick_sound_volume_slider = QSlider(Qt.Orientation.Horizontal, minimum=0, maximum=100, value=100)
+        self.quick_sound_volume_slider.valueChanged.connect(lambda value: self.client.set_volume(quick_sound=value / 100))
+        quick_volume_layout.addWidget(QLabel("Quick Sound Volume"))
+        quick_volume_layout.addWidget(self.quick_sound_volume_slider)
+        layout.addLayout(quick_volume_layout)
+
+        self.pick_file_button = QPushButton("Pick File", clicked=self.pick_file)
+        layout.addWidget(self.pick_file_button)
+        self.queue_model = QueueModel(self)
+        self.queue_list = QListView(uniformItemSizes=True)
+        self.queue_list.setModel(self.queue_model)
+        self.queue_list.setItemDelegate(QueueDelegate(self.queue_list))
+        layout.addWidget(self.queue_list)
+        self.stats_label = QLabel()
+        layout.addWidget(self.stats_label)
+        self.stats_timer = QTimer(self, interval=STATS_REFRESH_MS, timeout=self.client.refresh_stats)
+        self.stats_timer.start()
+
+        quick_sound_layout = QVBoxLayout()
+        self.quick_buttons = {i: QPushButton(f"Quick Sound {i}", clicked=lambda _, i=i: self.play_quick_sound(i)) for i in range(1, QUICK_SOUND_COUNT + 1)}
+        for button in self.quick_buttons.values():
+            quick_sound_layout.addWidget(button)
+        layout.addLayout(quick_sound_layout)
+
+        self.pending_state = None
+        self.refresh_timer = QTimer(self, singleShot=True, interval=REFRESH_INTERVAL_MS, timeout=self.flush_state)
+        self.client.state_changed.connect(self.apply_state)
+        self.client.stats_changed.connect(lambda lines: self.stats_label.setText("\n".join(lines)))
+        self.client.error.connect(lambda message: self.statusBar().showMessage(message, 5000))
+
+    # Takes a new state from the bot. It is shown straight away unless another state was shown
+    # less than REFRESH_INTERVAL_MS ago, in which case only the latest is shown when the interval ends.
+    @pyqtSlot(dict)
+    def apply_state(self, state):
+        if self.refresh_timer.isActive():
+            self.pending_state = state
+            return
+        self.show_state(state)
+        self.refresh_timer.start()
+
+    # Shows the last state that arrived while the window was holding back updates.
+    def flush_state(self):
+        if self.pending_state is not None:
+            state, self.pending_state = self.pending_state, None
+            self.show_state(state)
+            self.refresh_timer.start()
+
+    # Shows a state from the bot.
+    def show_state(self, state):
+        if state['ready'] and not self.state['ready']:
+            logger.info("Bot ready, connect button enabled.")
+        self.state = state
+        self.set_guilds([(guild['name'], guild['id']) for guild in state['guilds']])
+        if state['ready']:
+            self.set_slider(self.music_volume_slider, state['music_volume'])
+            self.set_slider(self.quick_sound_volume_slider, state['quick_sound_volume'])
+        for i, button in self.quick_buttons.items():
+            sound_file = state.get('quick_sounds', {}).get(f"Quick Sound {i}")
+            button.setText(os.path.basename(sound_file) if sound_file else f"Quick Sound {i}")
+        self.update_guild_controls()
+
+    # Moves a volume slider to the bot's value unless the user is dragging it.
+    def set_slider(self, slider, volume):
+        if not slider.isSliderDown():
+            slider.blockSignals(True)
+            slider.setValue(round(volume * 100))
+            slider.blockSignals(False)
+
+    # Fills the server selector with the guilds the bot is in, keeping the current choice.
+    def set_guilds(self, guilds):
+        if guilds == [(self.guild_combo.itemText(i), self.guild_combo.itemData(i)) for i in range(self.guild_combo.count())]:
+            return
+        self.guild_combo.blockSignals(True)
+        self.guild_combo.clear()
+        for name, guild_id in guilds:
+            self.guild_combo.addItem(name, guild_id)
+        index = self.guild_combo.findData(self.guild_id)
+        self.guild_combo.setCurrentIndex(index if index >= 0 else 0)
+        self.guild_combo.blockSignals(False)
+        self.select_guild(self.guild_combo.currentIndex())
+
+    # Switches the controls to the guild chosen in the server selector.
+    def select_guild(self, index):
+        self.guild_id = self.guild_combo.itemData(index) if index >= 0 else None
+        guild = self.selected_guild()
+        self.queue_model.reset(guild['queue'] if guild else [], bool(guild and guild['playing']))
+        self.update_guild_controls()
+
+    # Returns the selected guild's state, or None if no guild is selected.
+    def selected_guild(self):
+        return next((guild for guild in self.state['guilds'] if guild['id'] == self.guild_id), None)
+
+    # Sends a player control for the selected guild.
+    def run_on_player(self, action, body=None):
+        if self.guild_id is not None:
+            self.client.guild_action(self.guild_id, action, body)
+
+    # Updates the buttons and queue for the selected guild.
+    def update_guild_controls(self):
+        guild = self.selected_guild()
+        connected = bool(guild and guild['connected'])
+        self.connect_button.setEnabled(guild is not None and not connected)
+        self.disconnect_button.setEnabled(connected)
+        self.stop_button.setEnabled(bool(guild and (guild['playing'] or guild['queue'])))
+        self.queue_model.update(guild['queue'] if guild else [], bool(guild and guild['playing']))
+
+    # Opens a file dialog to pick an MP3 file and adds it to the queue.
+    def pick_file(self):
+        file_path, _ = QFileDialog.getOpenFileName(self, "Select File", "", "MP3 files (*.mp3);;All Files (*)")
+        if file_path:
+            self.run_on_player("queue", {'path': file_path})
+
+    # Assigns a sound file to a quick sound button.
+    def assign_sound(self, button_index):
+        button = self.quick_buttons[button_index]
+        file_path, _ = QFileDialog.getOpenFileName(self, f"Select Sound for {button.text()}", "", "MP3 files (*.mp3);;All Files (*)")
+        if file_path:
+            button.setText(os.path.basename(file_path))
+            self.client.assign_sound(f"Quick Sound {button_index}", file_path)
+
+    # Initiates playing a quick sound or prompts for assignment if none exists.
+    def play_quick_sound(self, button_index):
+        name = f"Quick Sound {button_index}"
+        if self.state.get('quick_sounds', {}).get(name):
+            self.run_on_player("quick-sound", {'name': name})
+        else:
+            self.prompt_assign_sound(button_index)
+
+    # Prompts the user to assign a sound to a quick sound button.
+    def prompt_assign_sound(self, button_index):
+        button = self.quick_buttons[button_index]
+        if QMessageBox.question(self, "No Sound", f"No sound for {button.text()}. Assign now?",
+                                QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No) == QMessageBox.StandardButton.Yes:
+            self.assign_sound(button_index)
+
+# Opens the window for the control API at url and returns the application's exit code when it closes.
+def run(url, token=None):
+    app = QApplication.instance() or QApplication(sys.argv)
+    client = ControlClient(url, token)
+    main_window = MainWindow(client)
+    main_window.show()
+    client.poll()
+    return app.exec()
+
+# Parses the command line.
+def parse_args():
+    parser = argparse.ArgumentParser(description="Window for a running music bot.")
+    parser.add_argument("--url", default=DEFAULT_URL, help=f"the bot's control API (default {DEFAULT_URL})")
+    parser.add_argument("--token", help="the bot's CONTROL_TOKEN, if it has one")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    sys.exit(run(args.url, args.token))